@@ -0,0 +1,234 @@
+'''Decoding of animated GIF and PNG images into sprite sheets.
+
+All the frames of an animation are decoded once, in the image decoding
+threads, and laid out in a grid in a single image (the sprite sheet). The
+sheet is packed into the shared image atlases where it fits, so several
+animations (and other small images) on a page are drawn together; showing
+another frame only changes the texture coordinates drawn.
+
+Frames are decoded using PIL when it's installed, otherwise pyglet's own
+animation decoding is used; both handle GIF. Animated PNGs (APNG) are only
+animated if PIL understands them (Pillow 7.1 and later), otherwise they're
+shown as still images like any other PNG.
+'''
+import math
+import struct
+import threading
+from cStringIO import StringIO
+
+import pyglet
+
+from bruce import image_loader
+
+def _decodes_apng():
+    if image_loader.Image is None:
+        return False
+    try:
+        from PIL import PngImagePlugin
+    except ImportError:
+        return False
+    return hasattr(PngImagePlugin, 'APNG_DISPOSE_OP_NONE')
+
+# whether animated PNGs can be decoded
+apng = _decodes_apng()
+
+def _read(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise EOFError
+    return data
+
+def _skip_sub_blocks(file):
+    while True:
+        size = ord(_read(file, 1))
+        if not size:
+            return
+        file.seek(size, 1)
+
+def _gif_frames(file, limit=2):
+    # walk the GIF's blocks counting image descriptors, stopping once we've
+    # seen `limit` so we needn't read the rest of the image data
+    header = _read(file, 13)
+    flags = ord(header[10])
+    if flags & 0x80:
+        file.seek(3 * 2 ** ((flags & 7) + 1), 1)
+    frames = 0
+    while True:
+        block = _read(file, 1)
+        if block == '\x2c':
+            frames += 1
+            if frames >= limit:
+                break
+            flags = ord(_read(file, 9)[8])
+            if flags & 0x80:
+                file.seek(3 * 2 ** ((flags & 7) + 1), 1)
+            # skip the LZW minimum code size then the image data
+            file.seek(1, 1)
+            _skip_sub_blocks(file)
+        elif block == '\x21':
+            file.seek(1, 1)
+            _skip_sub_blocks(file)
+        else:
+            break
+    return frames
+
+def _png_frames(file):
+    # an animated PNG has an acTL chunk before its first IDAT, so only the
+    # chunk headers up to there need reading
+    file.seek(8)
+    while True:
+        length, chunk = struct.unpack('>I4s', _read(file, 8))
+        if chunk == 'acTL':
+            return struct.unpack('>I', _read(file, 4))[0]
+        if chunk == 'IDAT':
+            return 1
+        file.seek(length + 4, 1)
+
+_animated = {}
+
+def is_animated(name):
+    '''Determine whether the named image resource is an animated GIF, or an
+    animated PNG if those can be decoded.
+    '''
+    if name not in _animated:
+        _animated[name] = False
+        file = pyglet.resource.file(name)
+        try:
+            header = file.read(8)
+            file.seek(0)
+            if header[:6] in ('GIF87a', 'GIF89a'):
+                _animated[name] = _gif_frames(file) > 1
+            elif header == '\x89PNG\r\n\x1a\n' and apng:
+                _animated[name] = _png_frames(file) > 1
+        except (EOFError, struct.error):
+            # truncated; let the decoder complain
+            pass
+        finally:
+            file.close()
+    return _animated[name]
+
+def _frame_duration(duration):
+    # like web browsers, treat very short frame durations as unspecified
+    if not duration or duration <= .01:
+        return .1
+    return duration
+
+def _decode_frames(name, data):
+    '''Decode the frames of an animation, returning its (width, height), the
+    frames' RGBA data (rows running bottom to top) and their durations.
+    '''
+    Image = image_loader.Image
+    frames = []
+    durations = []
+    if Image is not None:
+        image = Image.open(StringIO(data))
+        size = image.size
+        try:
+            while True:
+                frame = image.convert('RGBA')
+                if frame.size != size:
+                    frame = frame.resize(size)
+                frame = frame.transpose(Image.FLIP_TOP_BOTTOM)
+                frames.append(image_loader._image_bytes(frame))
+                durations.append(_frame_duration(
+                    image.info.get('duration', 0) / 1000.))
+                image.seek(image.tell() + 1)
+        except EOFError:
+            pass
+    else:
+        animation = pyglet.image.load_animation(name, file=StringIO(data))
+        image = animation.frames[0].image
+        size = (image.width, image.height)
+        for frame in animation.frames:
+            image = frame.image.get_image_data()
+            frames.append(image.get_data('RGBA', size[0] * 4))
+            durations.append(_frame_duration(frame.duration))
+    return size, frames, durations
+
+def _make_sheet(size, frames):
+    '''Lay the frames out in a grid, returning the sheet as an ImageData and
+    the number of columns.
+    '''
+    width, height = size
+    columns = int(math.ceil(math.sqrt(len(frames))))
+    rows = int(math.ceil(len(frames) / float(columns)))
+    pitch = width * 4
+    blank = '\0' * pitch
+    data = []
+    for row in range(rows):
+        row_frames = frames[row * columns:(row + 1) * columns]
+        row_frames += [None] * (columns - len(row_frames))
+        for y in range(height):
+            start = y * pitch
+            data.append(''.join([frame is None and blank or
+                frame[start:start + pitch] for frame in row_frames]))
+    sheet = pyglet.image.ImageData(width * columns, height * rows, 'RGBA',
+        ''.join(data))
+    return sheet, columns
+
+class Animation(object):
+    '''An animated image being decoded in the background.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.sheet = None
+        self.texture = None
+        self.error = None
+        self.decoded = threading.Event()
+
+    def decode(self):
+        try:
+            file = pyglet.resource.file(self.name)
+            try:
+                data = file.read()
+            finally:
+                file.close()
+            self.size, frames, self.durations = _decode_frames(self.name,
+                data)
+            self.sheet, self.columns = _make_sheet(self.size, frames)
+        except Exception, error:
+            self.error = error
+        self.decoded.set()
+
+    def wait(self):
+        self.decoded.wait()
+        if self.error is not None:
+            raise self.error
+
+    def get_frames(self):
+        '''Get the texture regions holding the frames. Must be called from
+        the main thread.
+        '''
+        if self.texture is None:
+            self.wait()
+            sheet = self.sheet
+            if sheet.width <= image_loader.ATLAS_SIZE - 2 and \
+                    sheet.height <= image_loader.ATLAS_SIZE - 2:
+                self.texture = image_loader.pack(sheet)
+            else:
+                self.texture = sheet.get_texture()
+            self.sheet = None
+
+            width, height = self.size
+            self.frames = []
+            for i in range(len(self.durations)):
+                x = (i % self.columns) * width
+                y = (i // self.columns) * height
+                self.frames.append(self.texture.get_region(x, y, width,
+                    height))
+        return self.frames
+
+_animations = {}
+
+def load(name):
+    '''Start decoding the named animated image resource in the background
+    if that's not already been done.
+
+    Returns an Animation.
+    '''
+    if name not in _animations:
+        _animations[name] = Animation(name)
+        image_loader.queue(_animations[name])
+    return _animations[name]
+
+__all__ = ['is_animated', 'load', 'Animation']
@@ -1,4 +1,7 @@
 import time
+import bisect
+import threading
+import Queue
 
 import pyglet
 
@@ -71,3 +74,175 @@ class AutoPlayer(object):
         else:
             self.pres.change_page(1)
 
+
+class BackgroundSource(pyglet.media.StreamingSource):
+    '''Decodes the audio of another source in a background thread, a few
+    seconds ahead of playback.
+    '''
+    # packets of decoded audio to get ahead by
+    queue_size = 64
+
+    # seconds playback waits for a packet before filling in with silence
+    timeout = .5
+
+    def __init__(self, source):
+        self.source = source
+        self.audio_format = source.audio_format
+        self._duration = source.duration
+        self._start()
+
+    def _start(self):
+        self.stopping = False
+        self.ended = False
+        self.timestamp = 0
+        self.packets = Queue.Queue(self.queue_size)
+        self.thread = threading.Thread(target=self._decode,
+            name='narration-decoder')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _decode(self):
+        while not self.stopping:
+            # the size asked for is only a hint
+            try:
+                audio_data = self.source._get_audio_data(65536)
+            except Exception:
+                # a corrupt or truncated file; end the narration here
+                audio_data = None
+            while not self.stopping:
+                try:
+                    self.packets.put(audio_data, timeout=.1)
+                    break
+                except Queue.Full:
+                    pass
+            if audio_data is None:
+                return
+
+    def _stop_decoding(self):
+        self.stopping = True
+        self.thread.join()
+
+    def _seek(self, timestamp):
+        self._stop_decoding()
+        self.source._seek(timestamp)
+        self._start()
+        self.timestamp = timestamp
+
+    def _get_audio_data(self, bytes):
+        if self.ended:
+            return None
+        # decoding's much faster than playback so this shouldn't wait
+        try:
+            audio_data = self.packets.get(timeout=self.timeout)
+        except Queue.Empty:
+            # no data yet; rather than stall the display, play a little
+            # silence (the clock is pulled back to the sound's position)
+            return self._silence(bytes)
+        if audio_data is None:
+            self.ended = True
+        else:
+            self.timestamp = audio_data.timestamp + audio_data.duration
+        return audio_data
+
+    def _silence(self, bytes):
+        audio_format = self.audio_format
+        bytes_per_second = audio_format.sample_rate * \
+            audio_format.channels * audio_format.sample_size // 8
+        bytes = min(bytes, bytes_per_second // 20)
+        bytes -= bytes % (audio_format.channels * audio_format.sample_size // 8)
+        if audio_format.sample_size == 8:
+            data = '\x80' * bytes
+        else:
+            data = '\0' * bytes
+        duration = float(bytes) / bytes_per_second
+        audio_data = pyglet.media.AudioData(data, bytes, self.timestamp,
+            duration)
+        self.timestamp += duration
+        return audio_data
+
+class NarrationPlayer(object):
+    '''Changes pages in time with a narration sound track.
+
+    The narration's playback position is the clock the page timings (from
+    --playback or --playspeed) are measured against, so the pages can't
+    drift away from it however long the presentation loops for. The
+    position reported by the audio driver only moves in steps, so the clock
+    runs from the wall clock and is pulled gently towards the audio
+    position, jumping to it if they get far apart.
+    '''
+    # how often (seconds) to check whether the page should change
+    interval = 1 / 20.
+
+    # fraction of the difference from the audio position corrected at each
+    # check, and the difference at which the clock jumps instead
+    drift_gain = .1
+    max_drift = .5
+
+    started = False
+
+    def __init__(self, options, pres):
+        self.options = options
+        self.pres = pres
+
+        # page timings from the start of the narration
+        num_pages = len(pres.pages)
+        if options.playback:
+            times = [float(l.split()[0]) for l in open(options.playback)]
+            self.times = [t - times[0] for t in times][:num_pages]
+        else:
+            delay = float(options.playspeed)
+            self.times = [n * delay for n in range(num_pages)]
+
+        source = BackgroundSource(pyglet.media.load(options.narration))
+        self.duration = source.duration
+        self.player = pyglet.media.Player()
+        self.player.queue(source)
+        if options.loop:
+            self.player.eos_action = self.player.EOS_LOOP
+        else:
+            self.player.eos_action = self.player.EOS_PAUSE
+        self.player.push_handlers(on_eos=self.on_eos)
+
+    def on_page_changed(self, page, num):
+        # the narration starts once the first page is displayed
+        if self.started:
+            return
+        self.started = True
+        self.page = 0
+        self.base_time = 0
+        self.base_wall = time.time()
+        self.player.play()
+        pyglet.clock.schedule_interval(self.check, self.interval)
+
+    def get_time(self):
+        '''Get the position in the narration, in seconds.
+        '''
+        now = time.time()
+        clock = self.base_time + now - self.base_wall
+        audio = self.player.time
+        if audio is None:
+            return clock
+        error = audio - clock
+        if abs(error) > self.max_drift:
+            # we've looped, or the audio's stalled
+            self.base_time = audio
+            self.base_wall = now
+            return audio
+        self.base_time += error * self.drift_gain
+        return clock + error * self.drift_gain
+
+    def check(self, dt):
+        page = max(0, bisect.bisect_right(self.times, self.get_time()) - 1)
+        if page == self.page:
+            return
+        # only change when the narration moves on to another page, so
+        # going back to look at something isn't undone straight away
+        self.page = page
+        self.pres.change_page(page - self.pres.page_num)
+
+    def on_eos(self):
+        if self.options.loop:
+            return
+        pyglet.clock.unschedule(self.check)
+        if self.options.autoquit:
+            pyglet.app.exit()
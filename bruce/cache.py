@@ -0,0 +1,108 @@
+'''On-disk caching of resources which are expensive to create.
+
+Each kind of cached resource gets its own directory under the cache
+directory, which is "~/.bruce/cache" unless specified with --cache-dir.
+Passing "--cache-dir=off" disables caching. Entries are pickled and stored
+in files named after the hash of their key.
+'''
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+
+from bruce import config
+
+DEFAULT_DIRECTORY = os.path.join('~', '.bruce', 'cache')
+
+def get_directory(kind):
+    '''Return the directory for the kind of cached resource, creating it if
+    necessary. Returns None if caching is disabled or not possible.
+    '''
+    base = getattr(getattr(config, 'options', None), 'cache_dir', None)
+    if not base:
+        base = DEFAULT_DIRECTORY
+    if base == 'off':
+        return None
+    directory = os.path.join(os.path.expanduser(base), kind)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            return None
+    return directory
+
+def data_hash(data):
+    '''Hash some content (eg. a file's bytes) for use in a cache key.
+    '''
+    return hashlib.sha1(data).hexdigest()
+
+def file_hash(path):
+    f = open(path, 'rb')
+    try:
+        return data_hash(f.read())
+    finally:
+        f.close()
+
+def get_filename(kind, key):
+    directory = get_directory(kind)
+    if directory is None:
+        return None
+    return os.path.join(directory, data_hash(repr(key)))
+
+def load(kind, key):
+    '''Load the entry stored for the key, returning None if there is none.
+    '''
+    filename = get_filename(kind, key)
+    if filename is None or not os.path.exists(filename):
+        return None
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        # replaced as we looked
+        return None
+    try:
+        try:
+            return pickle.load(f)
+        except Exception:
+            # corrupt or from an incompatible version; it'll be replaced
+            return None
+    finally:
+        f.close()
+
+def save(kind, key, value):
+    '''Store the value for the key, replacing any existing entry.
+
+    Caching is best-effort: if the entry can't be written it's skipped.
+    '''
+    filename = get_filename(kind, key)
+    if filename is None:
+        return
+    # write to a temporary file of our own first so readers (and other
+    # threads saving the same entry) never see half an entry
+    try:
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(filename),
+            suffix='.tmp')
+    except (IOError, OSError):
+        return
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        try:
+            os.rename(temp, filename)
+        except OSError:
+            # Windows won't rename over an existing file
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(temp, filename)
+    except (IOError, OSError):
+        # full or unwritable, or another thread got there first
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+
+__all__ = ['get_directory', 'data_hash', 'file_hash', 'get_filename',
+    'load', 'save']
@@ -0,0 +1,186 @@
+'''Prewarming of the font glyph textures used by a presentation.
+
+pyglet renders glyphs into its font texture atlases the first time they're
+laid out. Doing that for every font and character in the presentation before
+the first page is displayed avoids the work landing in the middle of a page
+change.
+
+The glyph textures and metrics are also stored in the on-disk cache so
+later runs may load them directly rather than rendering them again.
+'''
+import os
+import zlib
+
+import pyglet
+from pyglet.gl import *
+from pyglet.text import runlist
+from pyglet.font import ttf
+
+from bruce import cache
+
+# pyglet only holds on to a few recently used fonts, so keep a reference to
+# every font we've warmed up to stop its glyphs being discarded
+_fonts = {}
+
+# font family name -> hash of the font file contents, for font files added
+# using the resource directive
+_font_files = {}
+
+def add_font_file(filename):
+    '''Note the contents of a font resource so glyphs cached for it are
+    not used if the file changes.
+    '''
+    location = pyglet.resource.location(filename)
+    if not isinstance(location, pyglet.resource.FileLocation):
+        return
+    path = os.path.join(location.path, filename)
+    info = ttf.TruetypeInfo(path)
+    try:
+        family = info.get_name('family')
+    finally:
+        info.close()
+    if family:
+        _font_files[family] = cache.file_hash(path)
+
+def _cache_key(name, size, bold, italic, dpi):
+    # fonts not added as resources are identified by name alone
+    font_id = _font_files.get(name, 'system:%s'%name)
+    return (font_id, size, bold, italic, dpi)
+
+def _load_glyphs(font, key):
+    '''Load the font's glyph textures and metrics from the disk cache.
+    '''
+    entry = cache.load('glyphs', key)
+    if entry is None:
+        return
+    textures = []
+    for width, height, x, y, line_height, data in entry['textures']:
+        texture = font.texture_class.create_for_size(GL_TEXTURE_2D,
+            width, height, font.texture_internalformat)
+        image = pyglet.image.ImageData(width, height, 'A',
+            zlib.decompress(data))
+        texture.blit_into(image, 0, 0, 0)
+        texture.x, texture.y, texture.line_height = x, y, line_height
+        textures.append(texture)
+    for c, (n, x, y, width, height, baseline, lsb, advance) in \
+            entry['glyphs'].items():
+        glyph = textures[n].get_region(x, y, width, height)
+        glyph.set_bearings(baseline, lsb, advance)
+        font.glyphs[c] = glyph
+    font.textures[:0] = textures
+
+def _save_glyphs(font, key):
+    '''Store the font's glyph textures and metrics in the disk cache.
+    '''
+    textures = []
+    index = {}
+    for texture in font.textures:
+        index[texture] = len(textures)
+        data = texture.get_image_data().get_data('A', texture.width)
+        textures.append((texture.width, texture.height, texture.x,
+            texture.y, texture.line_height, zlib.compress(data)))
+    glyphs = {}
+    for c, glyph in font.glyphs.items():
+        if glyph.owner not in index:
+            continue
+        lsb, baseline = glyph.vertices[:2]
+        glyphs[c] = (index[glyph.owner], glyph.x, glyph.y, glyph.width,
+            glyph.height, -baseline, lsb, glyph.advance)
+    cache.save('glyphs', key, dict(textures=textures, glyphs=glyphs))
+
+def _add_document(usage, document):
+    text = document.text
+    iter = runlist.ZipRunIterator((
+        document.get_style_runs('font_name'),
+        document.get_style_runs('font_size'),
+        document.get_style_runs('bold'),
+        document.get_style_runs('italic'),
+    ))
+    for start, end, (name, size, bold, italic) in iter.ranges(0, len(text)):
+        key = (name, size, bool(bold), bool(italic))
+        usage.setdefault(key, set()).update(text[start:end])
+
+def collect(pages):
+    '''Determine the fonts used by the pages and the characters used with
+    each font.
+
+    Returns a dict mapping (font_name, font_size, bold, italic) to the set of
+    characters.
+    '''
+    usage = {}
+    for page in pages:
+        _add_document(usage, page.document)
+        for element in page.content.elements:
+            if hasattr(element, 'table'):
+                for document in element.table.cells.values():
+                    _add_document(usage, document)
+            elif hasattr(element, 'document'):
+                _add_document(usage, element.document)
+
+        layout = page.stylesheet['layout']
+        if layout.title is not None:
+            value = page.stylesheet.value
+            key = (value('title', 'font_name'), value('title', 'font_size'),
+                bool(value('title', 'bold', False)),
+                bool(value('title', 'italic', False)))
+            usage.setdefault(key, set()).update(layout.title)
+        if layout.footer is not None:
+            _add_document(usage, layout.footer)
+    return usage
+
+def prewarm(pages, dpi):
+    '''Render all the glyphs used in the pages into the font textures for
+    the given resolution.
+
+    Returns a dict mapping (font_name, font_size, bold, italic, dpi) to the
+    pyglet font.
+    '''
+    fonts = {}
+    for (name, size, bold, italic), chars in collect(pages).items():
+        # line breaks and the like are never rendered
+        text = u''.join(sorted(c for c in chars
+            if c >= u' ' and c not in u'\u2028\u2029'))
+        font = pyglet.font.load(name, size, bold=bold, italic=italic, dpi=dpi)
+
+        # distance field fonts cache their glyphs per face themselves
+        if getattr(font, 'distance_field', False):
+            font.get_glyphs(text)
+            fonts[name, size, bold, italic, dpi] = font
+            continue
+
+        # only a fresh font may have its glyphs loaded from the disk cache
+        key = _cache_key(name, size, bold, italic, dpi)
+        if not font.glyphs:
+            _load_glyphs(font, key)
+        num_glyphs = len(font.glyphs)
+        font.get_glyphs(text)
+        if len(font.glyphs) != num_glyphs:
+            _save_glyphs(font, key)
+
+        fonts[name, size, bold, italic, dpi] = font
+    _fonts.update(fonts)
+    return fonts
+
+def report(fonts):
+    '''Display the glyph texture usage of the fonts.
+    '''
+    total_size = total_used = 0
+    for key in sorted(fonts):
+        name, size, bold, italic, dpi = key
+        font = fonts[key]
+        size_bytes = used = 0
+        for texture in font.textures:
+            # glyph textures are GL_ALPHA, one byte per pixel
+            size_bytes += texture.width * texture.height
+            used += texture.y * texture.width + texture.x * texture.line_height
+        style = ' '.join([s for s, on in (('bold', bold), ('italic', italic))
+            if on])
+        print '%s %spt %s @%ddpi: %d glyphs, %d textures, %dKB (%dKB used)'%(
+            name, size, style, dpi, len(font.glyphs), len(font.textures),
+            size_bytes // 1024, used // 1024)
+        total_size += size_bytes
+        total_used += used
+    print 'Total glyph texture memory: %dKB (%dKB used)'%(total_size // 1024,
+        total_used // 1024)
+
+__all__ = ['add_font_file', 'collect', 'prewarm', 'report']
@@ -1,50 +1,114 @@
+import warnings
 
 import pyglet
 from pyglet.text.formats import structured
 
 from cocos.director import director
 
-def calculate_dimensions(width, height, image):
+from bruce import svg
+from bruce import redraw
+from bruce import animation
+from bruce import image_loader
+from bruce import tiled_image
+
+# the scale pages will be displayed at, as Page.get_scale() will return;
+# set by bruce.run once the window is open
+display_scale = 1.0
+
+# the (width, height) pages are laid out at before they're scaled to the
+# display, as Page.desired_size; set by bruce.run
+page_size = None
+
+def calculate_dimensions(width, height, image_size):
     # handle width and height, retaining aspect if only one is specified
+    image_width, image_height = image_size
     if height is not None and width is None:
-        scale = height / float(image.height)
-        width = int(scale * image.width)
+        scale = height / float(image_height)
+        width = int(scale * image_width)
     elif width is not None:
-        scale = width / float(image.width)
-        height = int(scale * image.height)
-    return width or image.width, height or image.height
+        scale = width / float(image_width)
+        height = int(scale * image_height)
+    return width or image_width, height or image_height
 
 class ImageElement(structured.ImageElement):
     def __init__(self, uri, width=None, height=None, fit=False):
         self.uri = uri
-        image = pyglet.resource.image(uri)
+
+        # we only need the image's size, which is usually in its header
+        self.image_size = image_loader.get_size(uri)
+        if self.image_size is None:
+            self.image_size = image_loader.load(uri).get_size()
+        image_width, image_height = self.image_size
 
         if fit:
-            # XXX actually use this somehow some day
-            # go for best fit
-            width, height = map(float, director.get_window_size())
-            scale = min(width / image.width, height / image.height)
-            width = int(image.width * scale)
-            height = int(image.height * scale)
+            # fill as much of the page as we can; like the page content this
+            # is scaled to the display by set_scale(), and decoded at that
+            # size below
+            if page_size is not None:
+                width, height = map(float, page_size)
+            else:
+                width, height = map(float, director.get_window_size())
+            scale = min(width / image_width, height / image_height)
+            width = int(image_width * scale)
+            height = int(image_height * scale)
 
         self.width_spec = width
         self.height_spec = height
         self.scale = 1.0
         self.opacity = 255
 
-        self.width, self.height = calculate_dimensions(width, height, image)
+        self.width, self.height = calculate_dimensions(width, height,
+            self.image_size)
+        self.vertex_lists = {}
+
+        self.tiles = None
+        self.loading = None
+        self.start_loading()
+
+        # skip structured.ImageElement's __init__ as it needs the texture
+        pyglet.text.document.InlineElement.__init__(self, self.height, 0,
+            self.width)
 
-        super(ImageElement, self).__init__(image, self.width, self.height)
+    def start_loading(self):
+        # images too large for a texture are displayed a tile at a time;
+        # others are decoded resampled to the size they'll be displayed
+        if tiled_image.needs_tiling(self.image_size) and \
+                not svg.is_svg(self.uri):
+            self.tiles = tiled_image.load(self.uri)
+        else:
+            self.loading = image_loader.load(self.uri,
+                (int(self.width*display_scale),
+                int(self.height*display_scale)))
 
+    @property
+    def image(self):
+        return self.loading.get_texture()
+
+    active = False
     def set_active(self, active):
-        # not interested
-        pass
+        # keep the image in memory while its page is displayed
+        if self.loading is not None and active != self.active:
+            if active:
+                self.loading.acquire()
+            else:
+                self.loading.release()
+        self.active = active
+
+    def prefetch(self):
+        if self.loading is not None:
+            self.loading.prefetch()
 
     def place(self, layout, x, y):
-        # override to use c4B and blending
-        group = pyglet.sprite.SpriteGroup(self.image.texture,
-            pyglet.gl.GL_SRC_ALPHA, pyglet.gl.GL_ONE_MINUS_SRC_ALPHA,
-            layout.top_group)
+        if self.tiles is not None:
+            self.vertex_lists[layout] = tiled_image.TiledImage(self.tiles,
+                layout, x, y + self.descent, self.width, self.height,
+                self.opacity)
+            return
+
+        # override to use c4B and blending; upload the texture first so the
+        # group knows whether it's been packed into an atlas
+        texture = self.image
+        group = image_loader.get_group(self.loading, layout.top_group)
 
         x1 = int(x)
         y1 = int(y + self.descent)
@@ -53,27 +117,141 @@ class ImageElement(structured.ImageElement):
         vertex_list = layout.batch.add(4, pyglet.gl.GL_QUADS, group,
             ('v2i', (x1, y1, x2, y1, x2, y2, x1, y2)),
             ('c4B', [255, 255, 255, self.opacity] * 4),
-            ('t3f', self.image.tex_coords))
+            ('t3f', texture.tex_coords))
         self.vertex_lists[layout] = vertex_list
 
     def remove(self, layout):
         self.vertex_lists[layout].delete()
         del self.vertex_lists[layout]
 
+    def scrolled(self, layout):
+        # tiled images only draw the parts in view
+        if self.tiles is not None and layout in self.vertex_lists:
+            self.vertex_lists[layout].update()
+
     def set_opacity(self, layout, opacity):
         self.opacity = int(opacity)
+        if self.tiles is not None:
+            self.vertex_lists[layout].set_opacity(self.opacity)
+            return
         self.vertex_lists[layout].colors[:] = [255, 255, 255, self.opacity]*4
 
     def set_scale(self, scale):
-        if self.scale == scale:
-            return
-
-        width, height = calculate_dimensions(self.width_spec, self.height_spec, self.image)
+        width, height = calculate_dimensions(self.width_spec, self.height_spec,
+            self.image_size)
         self.width = int(width*scale)
         self.height = int(height*scale)
+        self.scale = scale
+
+        # make sure we've a version of the image resampled to the new size
+        if self.loading is not None and \
+                self.loading.size not in (None, (self.width, self.height)):
+            if self.active:
+                self.loading.release()
+            self.loading = image_loader.load(self.uri,
+                (self.width, self.height))
+            if self.active:
+                self.loading.acquire()
 
         # update InlineElement attributes
         self.ascent = self.height
         self.descent = 0
         self.advance = self.width
 
+class AnimatedImageElement(ImageElement):
+    '''An animated GIF or PNG image.
+
+    The frames come from a sprite sheet (see bruce.animation) and are only
+    advanced while the image's page is displayed and it's in view. If the
+    frames can't be decoded the image is shown like any other.
+    '''
+    frame = 0
+    running = False
+
+    def start_loading(self):
+        self.animation = animation.load(self.uri)
+
+    def _static(self):
+        # fall back to showing the image as ImageElement does
+        warnings.warn('showing %r without animation: %s'%(self.uri,
+            self.animation.error))
+        self.animation = None
+        ImageElement.start_loading(self)
+        if self.active:
+            self.loading.acquire()
+
+    @property
+    def image(self):
+        if self.animation is None:
+            return self.loading.get_texture()
+        return self.animation.get_frames()[self.frame]
+
+    def set_active(self, active):
+        if self.animation is None:
+            ImageElement.set_active(self, active)
+            return
+        self.active = active
+        self._update_clock()
+
+    def place(self, layout, x, y):
+        if self.animation is not None:
+            try:
+                texture = self.image
+            except Exception:
+                self._static()
+        if self.animation is None:
+            ImageElement.place(self, layout, x, y)
+            return
+
+        # frames in the same atlas are drawn together
+        group = image_loader.get_texture_group(texture, layout.top_group)
+
+        x1 = int(x)
+        y1 = int(y + self.descent)
+        x2 = int(x + self.width)
+        y2 = int(y + self.height + self.descent)
+        vertex_list = layout.batch.add(4, pyglet.gl.GL_QUADS, group,
+            ('v2i', (x1, y1, x2, y1, x2, y2, x1, y2)),
+            ('c4B', [255, 255, 255, self.opacity] * 4),
+            ('t3f', texture.tex_coords))
+        self.vertex_lists[layout] = vertex_list
+        self._update_clock()
+
+    def remove(self, layout):
+        super(AnimatedImageElement, self).remove(layout)
+        self._update_clock()
+
+    def _update_clock(self):
+        # only animate while displayed and in view
+        running = self.active and bool(self.vertex_lists) and \
+            self.animation is not None
+        if running == self.running:
+            return
+        self.running = running
+        if running:
+            pyglet.clock.schedule_once(self._next_frame,
+                self.animation.durations[self.frame])
+        else:
+            pyglet.clock.unschedule(self._next_frame)
+
+    def _next_frame(self, dt):
+        frames = self.animation.get_frames()
+        self.frame = (self.frame + 1) % len(frames)
+        tex_coords = frames[self.frame].tex_coords
+        for vertex_list in self.vertex_lists.values():
+            vertex_list.tex_coords[:] = tex_coords
+        redraw.invalidate()
+        pyglet.clock.schedule_once(self._next_frame,
+            self.animation.durations[self.frame])
+
+def create_element(uri, **kw):
+    '''Create the element displaying the named image resource.
+    '''
+    try:
+        animated = animation.is_animated(uri)
+    except Exception:
+        # let ImageElement report any problem with the file
+        animated = False
+    if animated:
+        return AnimatedImageElement(uri, **kw)
+    return ImageElement(uri, **kw)
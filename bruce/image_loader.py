@@ -0,0 +1,436 @@
+'''Decoding of images in background threads.
+
+Decoding large JPEG and PNG files is slow, so it's started in a pool of
+threads as soon as an image is seen by the parser (image nodes, layout
+"image:" lines). Only the texture upload, which must happen on the main
+thread, waits until the image is first drawn.
+
+The size of an image is read from its file header so pages may be laid out
+without waiting for the pixels.
+
+Small images (icons, logos, layout decorations) are packed into shared
+texture atlases so all of those on a page may be drawn together.
+
+If PIL is installed images may be resampled to the size they're displayed
+at as they're decoded, rather than being uploaded at full size and scaled
+by the graphics card. The resampled images are kept in the on-disk cache.
+SVG images (see bruce.svg) are always drawn at the size they're displayed
+and cached the same way.
+
+Textures are kept within a memory budget: once more than `budget` bytes
+are in use the least recently drawn images not on an active page are
+evicted, to be decoded again if they're needed later. Images packed into
+atlases are small and stay put. The counts in `stats` show how well the
+budget suits the presentation.
+'''
+import struct
+import threading
+import Queue
+import zlib
+from cStringIO import StringIO
+
+import pyglet
+from pyglet.gl import *
+from pyglet.image import atlas
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+from bruce import cache
+from bruce import svg
+
+# number of decoding threads
+NUM_THREADS = 4
+
+# images no larger than this are packed into atlases of ATLAS_SIZE square
+ATLAS_MAX_IMAGE = 256
+ATLAS_SIZE = 1024
+
+# bytes of texture memory images may use before old ones are evicted
+budget = 256 * 1024 * 1024
+
+stats = dict(hits=0, misses=0, evictions=0, bytes=0)
+
+_queue = Queue.Queue()
+_threads = []
+
+def _worker():
+    while True:
+        image = _queue.get()
+        image.decode()
+
+def _start_threads():
+    for i in range(NUM_THREADS):
+        thread = threading.Thread(target=_worker, name='image-decoder-%d'%i)
+        thread.setDaemon(True)
+        thread.start()
+        _threads.append(thread)
+
+def read_size(file):
+    '''Determine an image's (width, height) from the header of a PNG, GIF,
+    JPEG or BMP file. Returns None for other formats.
+    '''
+    header = file.read(26)
+    if header.startswith('\x89PNG\r\n\x1a\n'):
+        return struct.unpack('>II', header[16:24])
+    if header[:6] in ('GIF87a', 'GIF89a'):
+        return struct.unpack('<HH', header[6:10])
+    if header.startswith('BM'):
+        width, height = struct.unpack('<ii', header[18:26])
+        return width, abs(height)
+    if header.startswith('\xff\xd8'):
+        # walk the JPEG segments looking for the start of frame
+        data = header[2:]
+        while True:
+            while len(data) < 9:
+                more = file.read(4096)
+                if not more:
+                    return None
+                data += more
+            if data[0] != '\xff':
+                return None
+            marker = ord(data[1])
+            if marker == 0xff:
+                # padding
+                data = data[1:]
+                continue
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack('>HH', data[5:9])
+                return width, height
+            length, = struct.unpack('>H', data[2:4])
+            skip = length + 2
+            if skip > len(data):
+                file.read(skip - len(data))
+                data = ''
+            else:
+                data = data[skip:]
+    return None
+
+_sizes = {}
+
+def get_size(name):
+    '''Read the (width, height) of the named image resource from its file
+    header. Returns None if it can't be determined without decoding.
+    '''
+    if name not in _sizes:
+        try:
+            file = pyglet.resource.file(name)
+            try:
+                if svg.is_svg(name):
+                    _sizes[name] = svg.read_size(file)
+                else:
+                    _sizes[name] = read_size(file)
+            finally:
+                file.close()
+        except Exception:
+            _sizes[name] = None
+    return _sizes[name]
+
+def _image_bytes(image):
+    if hasattr(image, 'tobytes'):
+        return image.tobytes()
+    return image.tostring()
+
+class LoadingImage(object):
+    '''An image being decoded in the background, optionally resampled to
+    `size`.
+
+    `width` and `height` (the size of the source image) are available
+    immediately if the file header could be read; get_texture() waits for
+    the decoding to finish.
+
+    While an image is acquired (its page is active) it won't be evicted.
+    '''
+    def __init__(self, name, size=None):
+        self.name = name
+        self.size = size
+        self.image_data = None
+        self.error = None
+        self.texture = None
+        self.decoded = threading.Event()
+        self.pending = True
+        self.packed = False
+        self.bytes = 0
+        self.refs = 0
+        self.last_used = 0
+
+        self.width = self.height = None
+        header_size = get_size(name)
+        if header_size is not None:
+            self.width, self.height = header_size
+
+    def decode(self):
+        try:
+            file = pyglet.resource.file(self.name)
+            try:
+                data = file.read()
+            finally:
+                file.close()
+            self.image_data = self._decode(data)
+            self.error = None
+        except Exception, error:
+            self.error = error
+        self.pending = False
+        self.decoded.set()
+
+    def _decode(self, data):
+        if svg.is_svg(self.name):
+            return self._rasterize(data)
+        if self.size is not None:
+            key = (cache.data_hash(data), self.size)
+            entry = cache.load('images', key)
+            if entry is None:
+                image = Image.open(StringIO(data))
+                source_size = image.size
+                if self.size[0] < source_size[0] and \
+                        self.size[1] < source_size[1]:
+                    image = image.convert('RGBA').resize(self.size,
+                        Image.ANTIALIAS)
+                    entry = dict(source_size=source_size,
+                        data=zlib.compress(_image_bytes(image)))
+                    cache.save('images', key, entry)
+            if entry is not None:
+                if self.width is None:
+                    self.width, self.height = entry['source_size']
+                width, height = self.size
+                # PIL's rows run top to bottom
+                return pyglet.image.ImageData(width, height, 'RGBA',
+                    zlib.decompress(entry['data']), -width * 4)
+
+        # no resampling needed (or possible)
+        image = pyglet.image.load(self.name, file=StringIO(data))
+        if self.width is None:
+            self.width, self.height = image.width, image.height
+        return image
+
+    def _rasterize(self, data):
+        key = ('svg', cache.data_hash(data), self.size)
+        entry = cache.load('images', key)
+        if entry is None:
+            source_size, format, pixels = svg.rasterize(data, self.size)
+            entry = dict(source_size=source_size, format=format,
+                data=zlib.compress(pixels))
+            cache.save('images', key, entry)
+        if self.width is None:
+            self.width, self.height = entry['source_size']
+        width, height = self.size or entry['source_size']
+        # cairo's rows run top to bottom
+        return pyglet.image.ImageData(width, height, entry['format'],
+            zlib.decompress(entry['data']), -width * 4)
+
+    def wait(self):
+        '''Wait for the image to be decoded.
+        '''
+        self.decoded.wait()
+        if self.error is not None:
+            # the resource path may have changed since the decode started,
+            # so try again before giving up
+            self.decode()
+        if self.error is not None:
+            raise self.error
+
+    def get_size(self):
+        if self.width is None:
+            self.wait()
+        return self.width, self.height
+
+    def resident(self):
+        '''Determine whether the image's pixels are in memory (or on their
+        way there.)
+        '''
+        return self.pending or self.texture is not None or \
+            self.image_data is not None
+
+    def prefetch(self):
+        '''Start decoding the image again if it's been evicted.
+        '''
+        if self.resident():
+            stats['hits'] += 1
+            return
+        stats['misses'] += 1
+        self.pending = True
+        self.decoded.clear()
+        queue(self)
+
+    def acquire(self):
+        '''Keep the image in memory until it's released.
+        '''
+        self.refs += 1
+        self.prefetch()
+
+    def release(self):
+        self.refs -= 1
+
+    def get_texture(self):
+        '''Get the texture holding the image, uploading it if this is the
+        first time (or it's been evicted since.) Must be called from the
+        main thread.
+        '''
+        global _clock
+        _clock += 1
+        self.last_used = _clock
+        if self.texture is None:
+            if not self.resident():
+                # evicted and nobody's asked for it back; decode it here
+                stats['misses'] += 1
+                self.decode()
+            self.wait()
+            image = self.image_data
+            if image.width <= ATLAS_MAX_IMAGE and \
+                    image.height <= ATLAS_MAX_IMAGE:
+                self.texture = pack(image)
+                self.packed = True
+                self.bytes = image.width * image.height * 4
+            else:
+                self.texture = image.get_texture(True)
+                self.bytes = self.texture.width * self.texture.height * 4
+            self.image_data = None
+            stats['bytes'] += self.bytes
+            _evict(self)
+        return self.texture
+
+    def evict(self):
+        '''Drop the image's texture; it'll be decoded again if needed.
+        '''
+        stats['evictions'] += 1
+        stats['bytes'] -= self.bytes
+        self.bytes = 0
+        self.texture = None
+        self.decoded.clear()
+
+# incremented on every image use, to find the least recently used
+_clock = 0
+
+def _evict(keep):
+    '''Evict the least recently used images not on an active page (other
+    than `keep`, which is in use) until the textures fit the budget again.
+    '''
+    if stats['bytes'] <= budget:
+        return
+    candidates = [image for image in _images.values()
+        if image.texture is not None and not image.packed and
+        not image.refs and image is not keep]
+    candidates.sort(key=lambda image: image.last_used)
+    for image in candidates:
+        if stats['bytes'] <= budget:
+            break
+        image.evict()
+
+_atlases = []
+
+def pack(image):
+    '''Copy the image into one of the shared texture atlases.
+
+    Returns the region of the atlas texture holding the image.
+    '''
+    # leave a transparent pixel around each image so scaled images don't
+    # pick up the edges of their neighbours
+    width, height = image.width + 2, image.height + 2
+    for texture_atlas in _atlases:
+        try:
+            x, y = texture_atlas.allocator.alloc(width, height)
+            break
+        except atlas.AllocatorException:
+            pass
+    else:
+        texture_atlas = atlas.TextureAtlas(ATLAS_SIZE, ATLAS_SIZE)
+        _atlases.append(texture_atlas)
+        x, y = texture_atlas.allocator.alloc(width, height)
+    texture_atlas.texture.blit_into(image, x + 1, y + 1, 0)
+    return texture_atlas.texture.get_region(x + 1, y + 1, image.width,
+        image.height)
+
+class ImageGroup(pyglet.graphics.Group):
+    '''Draws an image with alpha blending from whichever texture holds it
+    at the time, so the image may be evicted and reloaded underneath the
+    vertex lists using it.
+    '''
+    def __init__(self, image, parent=None):
+        super(ImageGroup, self).__init__(parent)
+        self.image = image
+
+    def set_state(self):
+        texture = self.image.get_texture()
+        self.target = texture.target
+        glEnable(self.target)
+        glBindTexture(self.target, texture.id)
+        glPushAttrib(GL_COLOR_BUFFER_BIT)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+
+    def unset_state(self):
+        glPopAttrib()
+        glDisable(self.target)
+
+_groups = {}
+
+def get_texture_group(texture, parent):
+    '''Get the group for drawing from the texture (or the texture holding
+    the region) with alpha blending.
+
+    Regions of the same texture share the group and so are drawn together.
+    '''
+    owner = getattr(texture, 'owner', texture)
+    key = (owner.id, parent)
+    if key not in _groups:
+        _groups[key] = pyglet.sprite.SpriteGroup(owner, GL_SRC_ALPHA,
+            GL_ONE_MINUS_SRC_ALPHA, parent)
+    return _groups[key]
+
+def get_group(image, parent):
+    '''Get the group for drawing the LoadingImage with alpha blending.
+
+    Images sharing an atlas share the group and so are drawn together.
+    '''
+    # whether the image is packed is only known once it's uploaded
+    texture = image.get_texture()
+    if image.packed:
+        return get_texture_group(texture, parent)
+    key = (image, parent)
+    if key not in _groups:
+        _groups[key] = ImageGroup(image, parent)
+    return _groups[key]
+
+def queue(job):
+    '''Run job.decode() in one of the decoding threads.
+    '''
+    if not _threads:
+        _start_threads()
+    _queue.put(job)
+
+def report():
+    '''Display the image cache counters.
+    '''
+    print 'Image cache: %d hits, %d misses, %d evictions, %dKB of %dKB used'%(
+        stats['hits'], stats['misses'], stats['evictions'],
+        stats['bytes'] // 1024, budget // 1024)
+
+_images = {}
+
+def load(name, size=None):
+    '''Start decoding the named image resource in the background if that's
+    not already been done. If `size` (width, height) is given the image is
+    resampled to that size (when PIL is available; SVG images are always
+    drawn at that size.)
+
+    Returns a LoadingImage.
+    '''
+    if (Image is None and not svg.is_svg(name)) or size is None or \
+            0 in size:
+        size = None
+    key = (name, size)
+    if key in _images:
+        _images[key].prefetch()
+        return _images[key]
+    stats['misses'] += 1
+    image = _images[key] = LoadingImage(name, size)
+    queue(image)
+    return image
+
+__all__ = ['load', 'queue', 'get_size', 'read_size', 'pack', 'get_group',
+    'get_texture_group', 'LoadingImage', 'ImageGroup', 'stats', 'report']
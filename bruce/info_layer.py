@@ -4,6 +4,8 @@ import pyglet
 import cocos
 from cocos.director import director
 
+from bruce import redraw
+
 class InfoLayer(cocos.layer.Layer):
     def __init__(self, show_timer, show_count, num_pages):
         super(InfoLayer, self).__init__()
@@ -23,7 +25,7 @@ class InfoLayer(cocos.layer.Layer):
                 anchor_x='right', anchor_y='bottom', batch=self.batch,
                 x=director.window.width, y=0)
             y = self.timer_label.content_height
-            pyglet.clock.schedule(self.update)
+            pyglet.clock.schedule_interval(self.update, .25)
 
         if show_count:
             self.count_label = pyglet.text.Label(
@@ -58,7 +60,10 @@ class InfoLayer(cocos.layer.Layer):
     def update(self, dt):
         if self.start_time is not None:
             t = time.time() - self.start_time
-            self.timer_label.text = '%02d:%02d'%(t//60, t%60)
+            text = '%02d:%02d'%(t//60, t%60)
+            if text != self.timer_label.text:
+                self.timer_label.text = text
+                redraw.invalidate()
 
     def draw(self):
         self.batch.draw()
@@ -9,6 +9,8 @@ from pyglet.gl import *
 
 from cocos.director import director
 
+from bruce import redraw
+
 #
 # Python Interpreter directive
 #
@@ -87,6 +89,13 @@ class ScrolledIncrementalTextLayout(pyglet.text.layout.IncrementalTextLayout):
                   tg._clip_width + 1,
                   tg._clip_height)
 
+class RedrawCaret(pyglet.text.caret.Caret):
+    '''Caret which requests a redraw each time it blinks.
+    '''
+    def _blink(self, dt):
+        super(RedrawCaret, self)._blink(dt)
+        redraw.invalidate()
+
 class Output:
     '''Utility for capturing stdout from an interactive session.
     '''
@@ -223,7 +232,7 @@ class InterpreterElement(pyglet.text.document.InlineElement):
         # modify our scissor based on its screen position (ugh)
         self.layout.top_group.parent_group = layout.top_group
 
-        self.caret = pyglet.text.caret.Caret(self.layout, color=self.style['color'][:3])
+        self.caret = RedrawCaret(self.layout, color=self.style['color'][:3])
         self.caret.position = len(self.document.text)
 
     def remove(self, layout):
@@ -235,6 +244,7 @@ class InterpreterElement(pyglet.text.document.InlineElement):
         self.caret = None
 
     def on_key_press(self, symbol, modifiers):
+        redraw.invalidate()
         if symbol == pyglet.window.key.TAB:
             return self.caret.on_text('\t')
         elif symbol in (pyglet.window.key.ENTER, pyglet.window.key.NUM_ENTER):
@@ -265,6 +275,8 @@ class InterpreterElement(pyglet.text.document.InlineElement):
         return pyglet.event.EVENT_HANDLED
 
     def on_text(self, symbol):
+        redraw.invalidate()
+
         # squash carriage return - we already handle them above
         if symbol == '\r':
             return pyglet.event.EVENT_HANDLED
@@ -273,6 +285,7 @@ class InterpreterElement(pyglet.text.document.InlineElement):
         return self.caret.on_text(symbol)
 
     def on_text_motion(self, motion):
+        redraw.invalidate()
         at_sol = self.caret.position == self.start_of_line
 
         if motion == pyglet.window.key.MOTION_UP:
@@ -329,6 +342,7 @@ class InterpreterElement(pyglet.text.document.InlineElement):
         if y < sy or y > sy + sh: return
         self.layout.view_x -= scroll_x
         self.layout.view_y += scroll_y * 32
+        redraw.invalidate()
         return True
 
 
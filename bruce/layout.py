@@ -14,6 +14,9 @@ from pyglet.gl import *
 import cocos
 
 from bruce.color import parse_color
+from bruce import image_loader
+from bruce import image as image_element
+from bruce import svg
 
 #
 # Layout directive
@@ -157,9 +160,21 @@ class LayoutLayer(cocos.layer.Layer):
 
         # position images
         for fname, halign, valign in self.spec.images:
-            image = pyglet.resource.image(fname)
+            # the sprites hold on to the texture so never let it go
+            if svg.is_svg(fname):
+                # drawn at the size it's displayed rather than scaled
+                width, height = image_loader.get_size(fname) or \
+                    image_loader.load(fname).get_size()
+                loading = image_loader.load(fname,
+                    (int(width * scale), int(height * scale)))
+                sprite_scale = 1
+            else:
+                loading = image_loader.load(fname)
+                sprite_scale = scale
+            loading.acquire()
+            image = loading.get_texture()
             s = pyglet.sprite.Sprite(image, x=0, y=0, batch=self.batch)
-            s.scale = scale
+            s.scale = sprite_scale
             if halign == 'center':
                 s.x = vw//2 - s.width//2
             elif halign == 'right':
@@ -262,19 +277,30 @@ class LayoutParser(object):
             else:
                 handler(rest.strip())
 
-    def handle_image(self, image):
+    def handle_image(self, spec):
         halign='left'
         valign='bottom'
-        if ';' in image:
-            fname, args = image.split(';', 1)
+        if ';' in spec:
+            fname, args = spec.split(';', 1)
             for arg in args.split(';'):
                 k, v = [e.strip() for e in arg.split('=')]
                 if k == 'halign': halign=v
                 elif k == 'valign': valign=v
         else:
-            fname = image
+            fname = spec
         self.layout.images.append((fname, halign, valign))
 
+        # start decoding it now so it's ready by the time the page is created
+        if svg.is_svg(fname):
+            # rasterize it at the size it'll be displayed
+            size = image_loader.get_size(fname)
+            scale = image_element.display_scale
+            if size is not None:
+                image_loader.load(fname, (int(size[0] * scale),
+                    int(size[1] * scale)))
+        else:
+            image_loader.load(fname)
+
     def handle_vgradient(self, gradient):
         w, h = cocos.director.director.window.get_size()
         s, e = [parse_color(color) for color in gradient.split(';')]
@@ -1,11 +1,17 @@
+import math
+
 import pyglet
+from pyglet.window import key
 import cocos
 from cocos.actions import FadeIn, FadeOut
 from cocos.director import director
 
+from bruce import redraw
+from bruce import text_flow
+
 class Page(cocos.scene.Scene):
     def __init__(self, document, stylesheet, elements, docnode,
-            expose_text_runs):
+            expose_text_runs, sounds=()):
         cocos.scene.Scene.__init__(self)
         pyglet.event.EventDispatcher.__init__(self)
 
@@ -18,15 +24,25 @@ class Page(cocos.scene.Scene):
 
         # actual page content
         self.content = PageContent(document, stylesheet, elements,
-            expose_text_runs)
+            expose_text_runs, sounds)
         self.add(self.content, z=0)
 
         self.docnode = docnode
         self.transition = stylesheet.get_transition()
 
-    def create(self, desired_size):
+    prepared = False
+    def prepare(self, desired_size):
+        '''Lay out the page decorations and start flowing the page text in
+        the background (if there are text_flow workers).
+        '''
         self.desired_size = desired_size
         self.layout.create()
+        self.content.prepare()
+        self.prepared = True
+
+    def create(self, desired_size):
+        if not self.prepared:
+            self.prepare(desired_size)
         self.content.create()
 
     def on_next(self):
@@ -92,18 +108,37 @@ class FadeSection(object):
             self.document.set_style(s, e, dict(color=color))
 
         self.layout.end_update()
+        redraw.invalidate()
 
     opacity = property(lambda s:s._opacity, set_opacity) 
 
 class PageContent(cocos.layer.Layer):
     is_event_handler = True
-    def __init__(self, document, stylesheet, elements, expose_text_runs):
+    def __init__(self, document, stylesheet, elements, expose_text_runs,
+            sounds=()):
         self.document = document
         self.stylesheet = stylesheet
         self.elements = elements
         self.expose_text_runs = expose_text_runs
+        self.sounds = sounds
         super(PageContent, self).__init__()
 
+    flow = None
+    def prepare(self):
+        x, y, vw, vh = self.parent.get_viewport()
+        scale = self.parent.get_scale()
+        for element in self.elements:
+            element.set_scale(scale)
+        self.flow = text_flow.submit(self.document, vw, int(scale*96))
+
+    def prefetch(self):
+        '''Get the page's images back into memory if they've been evicted,
+        ahead of the page being displayed.
+        '''
+        for element in self.elements:
+            if hasattr(element, 'prefetch'):
+                element.prefetch()
+
     def create(self):
         # create the layout
         self.batch = pyglet.graphics.Batch()
@@ -138,6 +173,9 @@ class PageContent(cocos.layer.Layer):
         for element in self.elements:
             element.set_active(True)
 
+        for cue in self.sounds:
+            cue.play()
+
     def on_exit(self):
         '''Invoked when the page is removed from the screen.
         '''
@@ -151,10 +189,13 @@ class PageContent(cocos.layer.Layer):
         if self._cb_hide_mouse_scheduled:
             self.cb_hide_mouse(0)
 
+        self.stop_scrolling()
+
     def on_next(self):
         for section in self.expose_text_runs:
             if section['on']: continue
             section['on'] = True
+            self.on_expose(section)
             if section['style'] == 'fade':
                 self.do(FadeIn(.5), FadeSection(self.text_layout, self.document, section))
             else:
@@ -166,6 +207,12 @@ class PageContent(cocos.layer.Layer):
                 self.text_layout.end_update()
             return pyglet.event.EVENT_HANDLED
 
+    def on_expose(self, section):
+        '''Invoked as a list item is exposed, before it's displayed.
+        '''
+        for cue in section.get('sounds', ()):
+            cue.play()
+
     def on_previous(self):
         for section in reversed(self.expose_text_runs):
             if not section['on']: continue
@@ -193,9 +240,10 @@ class PageContent(cocos.layer.Layer):
             element.set_scale(scale)
 
         # render the text lines to our batch
-        l = self.text_layout = pyglet.text.layout.IncrementalTextLayout(
+        flow, self.flow = self.flow, None
+        l = self.text_layout = text_flow.FlowedTextLayout(
             self.document, vw, vh, dpi=int(scale*96), multiline=True,
-            batch=self.batch)
+            batch=self.batch, flow=flow)
 
         # set dimensions & alignment in one go
         l.begin_update()
@@ -229,9 +277,104 @@ class PageContent(cocos.layer.Layer):
         self.create_layout(x, y, vw, vh, scale)
     '''
 
+    # Scrolling: input events only accumulate the distance to scroll, which
+    # update_scroll() applies to the layout once per frame. After a drag the
+    # content keeps moving at the drag's speed, slowing down with friction.
+    scroll_friction = 5         # how quickly the speed dies away
+    scroll_min_speed = 20       # pixels per second below which we stop
+    scroll_line = 32            # pixels per wheel click or arrow key press
+
+    _scroll_x = _scroll_y = 0
+    _scroll_velocity = 0
+    _scroll_scheduled = False
+    _dragging = False
+
+    def scroll(self, dx, dy):
+        '''Scroll the view (positive dy moves towards the top of the
+        content) on the next frame.
+        '''
+        self._scroll_x += dx
+        self._scroll_y += dy
+        if not self._scroll_scheduled:
+            self._scroll_scheduled = True
+            pyglet.clock.schedule(self.update_scroll)
+            redraw.hold(self)
+
+    def stop_scrolling(self):
+        self._scroll_x = self._scroll_y = self._scroll_velocity = 0
+        self._dragging = False
+        if self._scroll_scheduled:
+            self._scroll_scheduled = False
+            pyglet.clock.unschedule(self.update_scroll)
+            redraw.release(self)
+
+    def update_scroll(self, dt):
+        dx, dy = self._scroll_x, self._scroll_y
+        self._scroll_x = self._scroll_y = 0
+
+        if self._dragging:
+            # track the drag speed for when it's released
+            if dt:
+                self._scroll_velocity = (self._scroll_velocity + dy / dt) / 2
+        elif self._scroll_velocity:
+            dy += self._scroll_velocity * dt
+            self._scroll_velocity *= math.exp(-self.scroll_friction * dt)
+            if abs(self._scroll_velocity) < self.scroll_min_speed:
+                self._scroll_velocity = 0
+
+        l = self.text_layout
+        if dx:
+            l.view_x -= dx
+        if dy:
+            view_y = l.view_y
+            l.view_y += dy
+            if l.view_y == view_y:
+                # hit the top or bottom
+                self._scroll_velocity = 0
+
+        if dx or dy:
+            # let elements which only draw what's in view catch up
+            for element in self.elements:
+                if hasattr(element, 'scrolled'):
+                    element.scrolled(l)
+
+        if not (self._dragging or self._scroll_velocity or self._scroll_x or
+                self._scroll_y):
+            self.stop_scrolling()
+
+    def can_scroll(self):
+        l = self.text_layout
+        return l.content_height > l.height
+
     def on_mouse_scroll(self, x, y, scroll_x, scroll_y):
-        self.text_layout.view_x -= scroll_x
-        self.text_layout.view_y += scroll_y * 32
+        self._scroll_velocity = 0
+        self.scroll(scroll_x, scroll_y * self.scroll_line)
+
+    def on_mouse_press(self, x, y, button, modifiers):
+        # catch the content if it's still moving; the presentation still
+        # gets the press
+        self._scroll_velocity = 0
+
+    def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
+        self._dragging = True
+        self.scroll(0, -dy)
+
+    def on_mouse_release(self, x, y, button, modifiers):
+        # let go of the content, leaving it moving at the drag's speed
+        if self._dragging:
+            self._dragging = False
+            self.scroll(0, 0)
+
+    def on_text_motion(self, motion):
+        if not self.can_scroll():
+            return pyglet.event.EVENT_UNHANDLED
+        if motion == key.MOTION_UP:
+            self.scroll(0, self.scroll_line)
+        elif motion == key.MOTION_DOWN:
+            self.scroll(0, -self.scroll_line)
+        else:
+            return pyglet.event.EVENT_UNHANDLED
+        return pyglet.event.EVENT_HANDLED
 
     def on_mouse_motion(self, x, y, dx, dy):
         director.window.set_mouse_visible(True)
@@ -244,9 +387,6 @@ class PageContent(cocos.layer.Layer):
         self._cb_hide_mouse_scheduled = False
         director.window.set_mouse_visible(False)
 
-    def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
-        self.text_layout.view_y -= dy
-
     def draw(self):
         self.batch.draw()
 
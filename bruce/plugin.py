@@ -9,6 +9,8 @@ from pyglet.gl import *
 
 from cocos.director import director
 
+from bruce import redraw
+
 #
 # Plugin directive
 #
@@ -68,6 +70,12 @@ class PluginElement(pyglet.text.document.InlineElement):
 
     def set_active(self, active):
         self.implementation.set_active(active)
+        if not self.implementation.needs_redraw:
+            return
+        if active:
+            redraw.hold(self)
+        else:
+            redraw.release(self)
 
     def set_opacity(self, layout, opacity):
         # XXX multiple layouts
@@ -94,6 +102,11 @@ class PluginElement(pyglet.text.document.InlineElement):
 
 class Plugin(object):
     opacity = 255
+
+    # set to False if the plugin doesn't animate so the presentation may
+    # idle when it's only redrawing on demand
+    needs_redraw = True
+
     def __init__(self, w, h):
         pass 
 
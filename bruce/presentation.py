@@ -4,13 +4,20 @@ import pyglet
 import cocos
 from cocos.director import director
 from cocos import actions
+from cocos.scenes import transitions
 from pyglet.window import key, mouse
 
 from bruce import info_layer
+from bruce import snapshot
+from bruce import redraw
+from bruce import transition_monitor
+from bruce import glyph_cache
+from bruce import text_flow
 
 class Presentation(pyglet.event.EventDispatcher):
     def __init__(self, pages, start_page, show_timer,
-            show_count, desired_size):
+            show_count, desired_size, transition_fps=None,
+            glyph_report=False):
         director.window.set_mouse_visible(False)
 
         self.pages = pages
@@ -25,16 +32,39 @@ class Presentation(pyglet.event.EventDispatcher):
             self.push_handlers(self.info_layer)
 
         self.desired_size = desired_size
+        self.in_transition = False
+        self.glyph_report = glyph_report
+
+        # optionally downgrade transitions which are too slow
+        self.transition_monitor = None
+        if transition_fps is not None:
+            self.transition_monitor = transition_monitor.TransitionMonitor(
+                transition_fps)
+            self.push_handlers(self.transition_monitor)
 
     def start_presentation(self):
+        # render every glyph we'll need before laying out any pages
+        for page in self.pages:
+            page.desired_size = self.desired_size
+        dpi = int(self.pages[self.page_num].get_scale() * 96)
+        fonts = glyph_cache.prewarm(self.pages, dpi)
+        if self.glyph_report:
+            glyph_cache.report(fonts)
+
+        # start all the pages' text flowing (in parallel if there are
+        # workers) before creating any of them
+        for page in self.pages:
+            page.prepare(self.desired_size)
         for page in self.pages:
             page.create(self.desired_size)
+        text_flow.stop()
         self.page = self.pages[self.page_num]
+        self.page.content.prefetch()
         director.window.set_caption('Presentation: Slide %s'%(self.page_num+1))
         self.dispatch_event('on_page_changed', self.page, self.page_num)
         director.run(self.page)
 
-    def _enter_page(self, page, forward=True):
+    def _enter_page(self, page, forward=True, animate=True):
         # set up the initial page
         old_page = self.page
         self.page = page
@@ -43,29 +73,97 @@ class Presentation(pyglet.event.EventDispatcher):
         pyglet.gl.glClearColor(*bgcolor)
         page.desired_size = self.desired_size
 
-        # play the transition, if any
-        if forward and page.transition is not None:
-            duration = page.stylesheet['transition']['duration']
-            page.transition(page)
-        elif not forward and old_page.transition is not None:
-            duration = old_page.stylesheet['transition']['duration']
-            old_page.transition(page)
+        # play the transition, if any (going backwards uses the old page's)
+        if forward:
+            transition_page = page
+        else:
+            transition_page = old_page
+        transition = transition_page.transition
+        stylesheet = transition_page.stylesheet
+        name = stylesheet['transition']['name']
+        if self.transition_monitor is not None:
+            name = self.transition_monitor.choose(name)
+            transition = stylesheet.get_transition(name)
+
+        if not animate:
+            transition = None
+        if transition is not None:
+            duration = stylesheet['transition']['duration']
+            self._transition(transition, old_page, page)
         else:
             duration = 0
             director.replace(page)
 
-        # and cue up the on_page_changed event for when the transition finishes
-        # XXX would be nice to be able to be notified by Cocos when the transition finishes
-        def f(dt, self=self):
-            self.dispatch_event('on_page_changed', self.page, self.page_num)
-        pyglet.clock.schedule_once(f, duration + 0.1)
+        if self.transition_monitor is not None:
+            self.transition_monitor.start(name, duration)
+
+        # keep redrawing and watch for the end of the transition, which is
+        # when Cocos makes the page the running scene
+        self.in_transition = True
+        redraw.hold(self)
+        pyglet.clock.unschedule(self._check_transition)
+        pyglet.clock.schedule(self._check_transition)
 
         director.window.set_caption('Presentation: Slide %s'%(self.page_num+1))
 
+    def _check_transition(self, dt):
+        if director.scene is not self.page:
+            return
+        pyglet.clock.unschedule(self._check_transition)
+        self.in_transition = False
+        redraw.release(self)
+        self.dispatch_event('on_transition_finished', self.page, self.page_num)
+        self.dispatch_event('on_page_changed', self.page, self.page_num)
+
+        # the next page is the likeliest to be wanted
+        if self.page_num + 1 < len(self.pages):
+            self.pages[self.page_num + 1].content.prefetch()
+
+    def _transition(self, transition, old_page, page):
+        '''Run the transition between snapshots of the two pages so the
+        page content is only drawn once rather than every frame.
+        '''
+        old_snapshot = snapshot.snapshot(old_page)
+        new_snapshot = old_snapshot and snapshot.snapshot(page)
+        if new_snapshot is None:
+            # no render-to-texture, so transition the live pages
+            transition(page)
+        else:
+            transition(new_snapshot, src=old_snapshot)
+
     # XXX reinstate me?
     # def on_resize(self, viewport_width, viewport_height):
         # self.page.on_resize(viewport_width, viewport_height)
 
+    def _fast_forward(self):
+        '''Abandon the running transition (if any), putting the scenes it
+        was animating back as they were.
+        '''
+        transition = director.next_scene or director.scene
+        if not isinstance(transition, transitions.TransitionScene):
+            return
+
+        # stop everything the transition animates so none of its actions
+        # is left to call finish() later
+        transition.stop()
+        if transition.grid is not None:
+            transition.grid.active = False
+        for child in transition.get_children():
+            child.stop()
+            if transition.is_running and \
+                    child is getattr(transition, 'fadelayer', None):
+                # FadeTransition removes its colour layer itself on exit
+                child.visible = False
+            else:
+                transition.remove(child)
+
+        for scene in (transition.in_scene, transition.out_scene):
+            scene.position = (0, 0)
+            scene.scale = 1
+            scene.rotation = 0
+            scene.visible = True
+        director.replace(transition.in_scene)
+
     def change_page(self, dir):
         # determine the new page, with limits
         new = min(self.num_pages-1, max(0, self.page_num + dir))
@@ -74,15 +172,29 @@ class Presentation(pyglet.event.EventDispatcher):
         # leave the old page
         self.page_num = new
 
-        # enter the new page
-        self._enter_page(self.pages[self.page_num], dir>0)
+        # enter the new page on the next tick so that a burst of page changes
+        # only enters the final page
+        pyglet.clock.unschedule(self._enter_target)
+        pyglet.clock.schedule_once(self._enter_target, 0, dir>0)
+
+    def _enter_target(self, dt, forward):
+        page = self.pages[self.page_num]
+        if page is self.page:
+            return
+        if self.in_transition:
+            # still changing page, so skip straight to the target
+            self._fast_forward()
+            self._enter_page(page, forward, animate=False)
+        else:
+            self._enter_page(page, forward)
 
     def __next(self):
-        if not self.page.on_next():
+        # use the page we're going to be on, not the one being displayed
+        if not self.pages[self.page_num].on_next():
             self.change_page(1)
 
     def __previous(self):
-        if not self.page.on_previous():
+        if not self.pages[self.page_num].on_previous():
             self.change_page(-1)
 
     def dispatch_event(self, event_type, *args):
@@ -142,5 +254,6 @@ class Presentation(pyglet.event.EventDispatcher):
         return pyglet.event.EVENT_UNHANDLED
 
 Presentation.register_event_type('on_page_changed')
+Presentation.register_event_type('on_transition_finished')
 Presentation.register_event_type('on_close')
 
@@ -0,0 +1,99 @@
+'''On-demand redrawing of the presentation window.
+
+By default the window is redrawn on every pass through the event loop. When
+on-demand redrawing is installed the window is only redrawn when something
+has marked it as needing a redraw:
+
+- user input, window exposure or resizing (handled here),
+- an animation (transition, fade) which calls animate() for its duration,
+- an element which is continually changing (video, plugins) and calls
+  hold() while it's active and release() when it's done.
+
+While the window is hidden or minimised nothing is drawn at all.
+
+All of the functions here are safe to call when on-demand redrawing has not
+been installed; they do nothing.
+'''
+import pyglet
+
+class RedrawHandler(object):
+    def __init__(self, window):
+        self.window = window
+        self.holders = set()
+        self.visible = True
+        self.window.invalid = True
+
+    def invalidate(self):
+        if self.visible:
+            self.window.invalid = True
+
+    def hold(self, holder):
+        self.holders.add(holder)
+        self.invalidate()
+
+    def release(self, holder):
+        self.holders.discard(holder)
+        # draw once more to display the final state
+        self.invalidate()
+
+    def animate(self, duration):
+        '''Keep redrawing for the next `duration` seconds.
+        '''
+        holder = object()
+        self.hold(holder)
+        def f(dt, holder=holder, self=self):
+            self.release(holder)
+        pyglet.clock.schedule_once(f, duration)
+
+    # window event handlers; none of these consume the event
+    def on_draw(self):
+        # this frame is being drawn now; only draw the next if we must
+        self.window.invalid = self.visible and bool(self.holders)
+
+    def on_hide(self):
+        self.visible = False
+        self.window.invalid = False
+
+    def on_show(self):
+        self.visible = True
+        self.invalidate()
+
+    def _input(self, *args):
+        self.invalidate()
+    on_key_press = on_key_release = on_text = on_text_motion = _input
+    on_mouse_motion = on_mouse_drag = on_mouse_scroll = _input
+    on_mouse_press = on_mouse_release = _input
+    on_expose = on_resize = on_activate = on_deactivate = _input
+
+_handler = None
+
+def install(window):
+    '''Switch the window over to being redrawn only on demand.
+    '''
+    global _handler
+    _handler = RedrawHandler(window)
+    window.push_handlers(_handler)
+
+def invalidate():
+    '''Request a single redraw of the window.
+    '''
+    if _handler is not None:
+        _handler.invalidate()
+
+def hold(holder):
+    '''Keep redrawing the window every frame until release(holder).
+    '''
+    if _handler is not None:
+        _handler.hold(holder)
+
+def release(holder):
+    if _handler is not None:
+        _handler.release(holder)
+
+def animate(duration):
+    '''Keep redrawing the window every frame for `duration` seconds.
+    '''
+    if _handler is not None:
+        _handler.animate(duration)
+
+__all__ = ['install', 'invalidate', 'hold', 'release', 'animate']
@@ -31,12 +31,14 @@ except ImportError:
 from bruce import page
 from bruce import pygments_parser
 from bruce import config
-from bruce.image import ImageElement
+from bruce import glyph_cache
+from bruce.image import create_element as create_image_element
 
 # custom reST directives
 from bruce import layout; layout.register_directives()
 from bruce import interpreter; interpreter.register_directives()
 from bruce import video; video.register_directives()
+from bruce import sound; sound.register_directives()
 from bruce import plugin; plugin.register_directives()
 from bruce import code_block; code_block.register_directives()
 from bruce import blank; blank.register_directives()
@@ -232,7 +234,7 @@ class DocutilsDecoder(structured.StructuredTextDecoder):
         d = g.decode(node)
         if g.len_text or g.is_blank:
             p = page.Page(d, self.stylesheet.copy(), d.elements, node,
-                g.expose_text_runs)
+                g.expose_text_runs, g.sounds)
             self.pages.append(p)
 
         self.stylesheet = g.next_stylesheet
@@ -267,6 +269,9 @@ class DocumentGenerator(structured.StructuredTextDecoder):
         self.is_blank = False
         self.expose_text_runs = []
 
+        # sound cues played on entering the page
+        self.sounds = []
+
     def decode_structured(self, doctree, location):
         # attach a reporter so docutil's walkabout doesn't get confused by us
         # not using a real document as the root
@@ -403,7 +408,7 @@ class DocumentGenerator(structured.StructuredTextDecoder):
             kw['width'] = int(node['width'])
         if node.has_key('height'):
             kw['height'] = int(node['height'])
-        self.add_element(ImageElement(node['uri'].strip(), **kw))
+        self.add_element(create_image_element(node['uri'].strip(), **kw))
 
     def visit_blank(self, node):
         self.is_blank = True
@@ -427,6 +432,16 @@ class DocumentGenerator(structured.StructuredTextDecoder):
 
         self.add_element(node.get_video())
 
+    def visit_sound(self, node):
+        # cues in an exposed list item play when it's exposed, others when
+        # the page is entered
+        cue = node.get_sound()
+        if self.open_expose_run is not None:
+            self.open_expose_run['sounds'].append(cue)
+        else:
+            self.sounds.append(cue)
+        self.prune()
+
     def visit_interpreter(self, node):
         # if the parent is structural - document, section, etc then we need
         # to break the previous paragraphish
@@ -500,6 +515,8 @@ class DocumentGenerator(structured.StructuredTextDecoder):
 
     in_item = False
     item_depth = 0
+    # the expose run of the list item we're in, if it's exposed gradually
+    open_expose_run = None
     def visit_list_item(self, node):
         self.break_paragraph()
 
@@ -523,16 +540,18 @@ class DocumentGenerator(structured.StructuredTextDecoder):
         # yep, we want the contents of this node marked for gradual exposure
         color = self.stylesheet.value('default', 'color')
         self.push_style(node, dict(color=color))
-        self.expose_text_runs.append(dict(style=expose, start=self.len_text,
-            on=False, elements=[]))
+        self.open_expose_run = dict(style=expose, start=self.len_text,
+            on=False, elements=[], sounds=[])
+        self.expose_text_runs.append(self.open_expose_run)
 
     def close_expose_run(self):
-        if self.item_depth != 1 or not self.expose_text_runs:
+        if self.item_depth != 1 or self.open_expose_run is None:
             return
 
         # get list of [(start, end, color)] for the document text of the list
         # item contents
-        run = self.expose_text_runs[-1]
+        run = self.open_expose_run
+        self.open_expose_run = None
         iter = self.document.get_style_runs('color')
         run['runs'] = [[s, e, c] for s, e, c in iter.ranges(run['start'],
             self.len_text)]
@@ -652,6 +671,7 @@ class DocumentGenerator(structured.StructuredTextDecoder):
         resource_name = node.get_resource()
         if resource_name.lower().endswith('.ttf'):
             pyglet.resource.add_font(resource_name)
+            glyph_cache.add_font_file(resource_name)
         elif not os.path.isabs(resource_name):
             # try to find the resource inside an existing resource directory
             for path in pyglet.resource.path:
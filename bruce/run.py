@@ -7,13 +7,14 @@ import textwrap
 from cgi import escape as html_quote
 
 import pyglet
+import cocos
 from cocos.director import director
-from cocos import actions
 
 from bruce import display_source
 from bruce import style
 from bruce import auto_player
 from bruce import config
+from bruce import redraw
 
 def main():
     '''Run either the command-line or gui interface depending on whether any
@@ -103,9 +104,19 @@ class GUI(object):
             record = ''
             playback = ''
             playspeed = ''
+            narration = ''
             loop = False
             autoquit = False
             smartypants = 'qbD'
+            redraw_on_demand = False
+            adaptive_transitions = None
+            glyph_report = False
+            cache_dir = ''
+            sdf_text = False
+            layout_workers = 0
+            image_cache = 256
+            image_report = False
+            video_report = False
         config.options = options
         run(self.filename, options)
 
@@ -148,12 +159,53 @@ def cmd_line():
     p.add_option("", "--playspeed", dest="playspeed", default="",
                       help="play a presentation at a constant speed "
                            "(supply seconds to pause per page)")
+    p.add_option("", "--narration", dest="narration", default="",
+                      help="play this sound file while playing back (with "
+                           "--playback or --playspeed), keeping the page "
+                           "changes in time with it")
     p.add_option("", "--loop", dest="loop", default=False, action="store_true",
                       help="loop back to the start when playing automatically")
     p.add_option("", "--autoquit", dest="autoquit", default=False, action="store_true",
                       help="quit Bruce after playing through the " \
                           "presentation once automatically")
 
+    p.add_option("", "--redraw-on-demand", dest="redraw_on_demand",
+                      default=False, action="store_true",
+                      help="only redraw the display when something changes "
+                           "(saves power when idle)")
+
+    p.add_option("", "--adaptive-transitions", dest="adaptive_transitions",
+                      type="float", default=None,
+                      help="replace transitions which can't run at the given "
+                           "frames per second with cheaper ones")
+
+    p.add_option("", "--cache-dir", dest="cache_dir", default="",
+                      help="directory to cache rendered glyphs etc. in "
+                           "(default ~/.bruce/cache, \"off\" to disable)")
+    p.add_option("", "--sdf-text", dest="sdf_text",
+                      default=False, action="store_true",
+                      help="render text from signed distance field glyphs "
+                           "shared between all sizes of a font")
+    p.add_option("", "--layout-workers", dest="layout_workers",
+                      type="int", default=0,
+                      help="number of worker processes to lay out page text "
+                           "in (default 0, don't use workers)")
+    p.add_option("", "--image-cache", dest="image_cache",
+                      type="int", default=256,
+                      help="megabytes of texture memory to keep images in "
+                           "(default 256)")
+    p.add_option("", "--image-report", dest="image_report",
+                      default=False, action="store_true",
+                      help="report image cache use on exit")
+    p.add_option("", "--video-report", dest="video_report",
+                      default=False, action="store_true",
+                      help="report video frames decoded, shown and dropped "
+                           "on exit")
+    p.add_option("", "--glyph-report", dest="glyph_report",
+                      default=False, action="store_true",
+                      help="report the fonts used and the texture memory "
+                           "their glyphs occupy")
+
     p.add_option("-b", "--bullet-mode", dest="bullet_mode",
                       action="store_true", default=False,
                       help="run in bullet mode (page per bulet)")
@@ -178,6 +230,19 @@ def cmd_line():
     (options, args) = p.parse_args()
     config.options = options
 
+    if options.adaptive_transitions is not None and \
+            options.adaptive_transitions <= 0:
+        p.error('--adaptive-transitions must be a positive frame rate')
+
+    if options.narration and not (options.playback or options.playspeed):
+        p.error('--narration needs --playback or --playspeed')
+
+    if options.layout_workers < 0:
+        p.error('--layout-workers must not be negative')
+
+    if options.image_cache < 0:
+        p.error('--image-cache must not be negative')
+
     if options.version:
         print __version__
         sys.exit(0)
@@ -215,6 +280,28 @@ transformations completely off.
     run(args[0], options)
 
 
+class ScreenGrab(cocos.cocosnode.CocosNode):
+    '''Invoke the callback once from the page's drawing, after everything
+    else on the page has been drawn but before the frame is displayed.
+    '''
+    def __init__(self, callback):
+        super(ScreenGrab, self).__init__()
+        self.callback = callback
+        self.done = False
+
+    def draw(self):
+        if self.done:
+            return
+        self.done = True
+        self.callback()
+        # the parent is part way through drawing its children, so leave
+        # them alone until it's done
+        pyglet.clock.schedule_once(self._remove, 0)
+
+    def _remove(self, dt):
+        if self.parent is not None and self in self.parent.get_children():
+            self.parent.remove(self)
+
 def run(filename, options):
     from bruce import rst_parser
     from bruce import presentation
@@ -236,6 +323,11 @@ def run(filename, options):
     pyglet.resource.path.append(directory)
     pyglet.resource.reindex()
 
+    # start the text layout workers before we've a window to inherit
+    if options.layout_workers:
+        from bruce import text_flow
+        text_flow.start(options.layout_workers)
+
     # initialise the display
     display = pyglet.window.get_platform().get_default_display()
     screen = display.get_screens()[screen]
@@ -246,6 +338,20 @@ def run(filename, options):
         director.init(width=width, height=height,
             screen=screen, do_not_scale=True, visible=False)
 
+    # images are decoded at the size they'll be displayed, which depends on
+    # how much we'll scale the pages (as Page.get_scale() will)
+    from bruce import image
+    w, h = director.window.get_size()
+    image.display_scale = min(w / float(width), h / float(height))
+    image.page_size = (width, height)
+    from bruce import image_loader
+    image_loader.budget = options.image_cache * 1024 * 1024
+
+    # switch text rendering over before any fonts are loaded
+    if options.sdf_text:
+        from bruce import sdf_text
+        sdf_text.install()
+
     # grab the presentation content and parse into pages
     content = file(filename).read()
     if options.style == 'not specified':
@@ -263,7 +369,9 @@ def run(filename, options):
     pres = presentation.Presentation(pages,
         show_timer=options.timer, show_count=options.page_count,
         start_page=int(options.start_page)-1,
-        desired_size=(width, height))
+        desired_size=(width, height),
+        transition_fps=options.adaptive_transitions,
+        glyph_report=options.glyph_report)
 
     # listen for page changes if we're recording
     if options.record:
@@ -282,12 +390,16 @@ def run(filename, options):
                 filename = os.path.join(options.record, filename)
                 buffer = pyglet.image.get_buffer_manager().get_color_buffer()
                 buffer.save(filename)
-            # delay a moment to allow rendering to complete
-            page.do(actions.Delay(.1) + actions.CallFunc(save))
+            # the transition has finished so grab the next frame drawn
+            page.add(ScreenGrab(save), z=1)
+            redraw.invalidate()
 
     # playback?
     if options.playback or options.playspeed:
-        auto = auto_player.AutoPlayer(options, pres)
+        if options.narration:
+            auto = auto_player.NarrationPlayer(options, pres)
+        else:
+            auto = auto_player.AutoPlayer(options, pres)
         pres.push_handlers(auto)
 
     director.window.push_handlers(pres)
@@ -308,11 +420,21 @@ def run(filename, options):
     if options.source:
         pres.push_handlers(display_source.DisplaySource())
 
+    # handlers go on top of the presentation's so they see all input
+    if options.redraw_on_demand:
+        redraw.install(director.window)
+
     director.window.set_visible(True)
 
     # now that we're all set up, load up the first page
     pres.start_presentation()
 
+    if options.image_report:
+        image_loader.report()
+    if options.video_report:
+        from bruce import video_player
+        video_player.report()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,277 @@
+'''Signed distance field text rendering.
+
+Normally pyglet renders a separate set of glyph bitmaps for every font size
+and resolution used. With distance field text each font face is rasterised
+just once, at a reference size, and stored as a signed distance field: every
+texel holds the distance to the nearest edge of the glyph outline. A
+fragment shader then reconstructs crisp edges from the field when drawing
+the glyphs at any size or scale, so all sizes of a face share one texture
+atlas.
+
+The distance fields are stored in the on-disk cache along with the other
+glyph textures (see bruce.glyph_cache).
+
+This is optional; install() switches pyglet's text rendering over and
+reports whether the shader is supported by the OpenGL driver.
+'''
+import math
+import array
+import warnings
+
+import pyglet
+from pyglet.gl import *
+from pyglet.font import base
+from pyglet.text import layout
+
+from bruce import glyph_cache
+
+# size in pixels the faces are rasterised at
+REFERENCE_SIZE = 48
+
+# how far (in reference pixels) the field extends beyond the glyph outlines
+SPREAD = 6
+
+_fragment_shader = '''
+uniform sampler2D glyphs;
+
+void main() {
+    // 0.5 is the glyph outline; antialias over about a pixel on screen
+    float distance = texture2D(glyphs, gl_TexCoord[0].st).a;
+    float width = fwidth(distance);
+    float alpha = smoothstep(0.5 - width, 0.5 + width, distance);
+    gl_FragColor = vec4(gl_Color.rgb, gl_Color.a * alpha);
+}
+'''
+
+_INF = 1e20
+
+def _edt_1d(f):
+    '''Squared euclidean distance transform of a row of samples
+    (Felzenszwalb & Huttenlocher).
+    '''
+    n = len(f)
+    v = [0] * n
+    z = [0] * (n + 1)
+    z[0] = -_INF
+    z[1] = _INF
+    k = 0
+    for q in range(1, n):
+        s = ((f[q] + q*q) - (f[v[k]] + v[k]*v[k])) / (2. * (q - v[k]))
+        while s <= z[k]:
+            k -= 1
+            s = ((f[q] + q*q) - (f[v[k]] + v[k]*v[k])) / (2. * (q - v[k]))
+        k += 1
+        v[k] = q
+        z[k] = s
+        z[k+1] = _INF
+    d = [0] * n
+    k = 0
+    for q in range(n):
+        while z[k+1] < q:
+            k += 1
+        d[q] = (q - v[k])**2 + f[v[k]]
+    return d
+
+def _edt(grid, width, height):
+    for x in range(width):
+        grid[x::width] = _edt_1d(grid[x::width])
+    for y in range(height):
+        i = y * width
+        grid[i:i+width] = _edt_1d(grid[i:i+width])
+
+def distance_field(alpha, width, height, flip=False):
+    '''Compute the signed distance field for an alpha bitmap.
+
+    The field is SPREAD pixels larger than the bitmap on every side. Returns
+    the field as alpha bytes, where 128 is the outline and values increase
+    towards the inside of the glyph.
+    '''
+    w = width + 2 * SPREAD
+    h = height + 2 * SPREAD
+    inside = [False] * (w * h)
+    for y in range(height):
+        row = (height - 1 - y) if flip else y
+        src = row * width
+        dst = (y + SPREAD) * w + SPREAD
+        for x in range(width):
+            if ord(alpha[src + x]) >= 128:
+                inside[dst + x] = True
+
+    # squared distances to the nearest inside and outside pixels
+    outer = [i and 0 or _INF for i in inside]
+    inner = [i and _INF or 0 for i in inside]
+    _edt(outer, w, h)
+    _edt(inner, w, h)
+
+    scale = 127. / SPREAD
+    field = array.array('B')
+    for i in range(w * h):
+        # the outline lies half a pixel between inside and outside pixels
+        if inside[i]:
+            d = .5 - math.sqrt(inner[i])
+        else:
+            d = math.sqrt(outer[i]) - .5
+        field.append(max(0, min(255, int(128 - d * scale))))
+    return field.tostring()
+
+class SDFTextureAtlas(base.GlyphTextureAtlas):
+    '''Glyph texture holding distance fields rather than glyph bitmaps.
+    '''
+
+class SDFFace(base.Font):
+    '''The distance field glyphs for a font face, shared by all sizes and
+    resolutions of the face.
+    '''
+    texture_width = 512
+    texture_height = 512
+    texture_class = SDFTextureAtlas
+
+    def __init__(self, name, bold, italic):
+        super(SDFFace, self).__init__()
+        self.font = _base_class(name, REFERENCE_SIZE, bold=bold,
+            italic=italic, dpi=72)
+        self.ascent = self.font.ascent
+        self.descent = self.font.descent
+        self.key = glyph_cache._cache_key(name, REFERENCE_SIZE, bold, italic,
+            72) + ('sdf', SPREAD)
+        glyph_cache._load_glyphs(self, self.key)
+
+    def add_glyphs(self, chars):
+        '''Make sure the distance fields for all the characters have been
+        generated.
+        '''
+        new = [c for c in chars if c not in self.glyphs]
+        if not new:
+            return
+        for c in new:
+            self.glyphs[c] = self._render(c)
+        glyph_cache._save_glyphs(self, self.key)
+
+    def _render(self, c):
+        glyph = self.font.get_glyphs(c)[0]
+        width, height = glyph.width, glyph.height
+        if not width or not height:
+            image = pyglet.image.ImageData(0, 0, 'A', '')
+            region = self.create_glyph(image)
+            region.set_bearings(0, 0, glyph.advance)
+            return region
+
+        # some platforms render glyphs upside down and flip the texture
+        # coordinates; store the field the right way up
+        t = glyph.tex_coords
+        flip = t[1] > t[7]
+        alpha = glyph.get_image_data().get_data('A', width)
+        field = distance_field(alpha, width, height, flip)
+        image = pyglet.image.ImageData(width + 2 * SPREAD,
+            height + 2 * SPREAD, 'A', field)
+        region = self.create_glyph(image)
+        lsb, bottom = glyph.vertices[:2]
+        region.set_bearings(SPREAD - bottom, lsb - SPREAD, glyph.advance)
+        return region
+
+_faces = {}
+
+def get_face(name, bold, italic):
+    key = (name, bool(bold), bool(italic))
+    if key not in _faces:
+        _faces[key] = SDFFace(name, bold, italic)
+    return _faces[key]
+
+class SDFGlyphRenderer(base.GlyphRenderer):
+    def __init__(self, font):
+        self.font = font
+
+    def render(self, text):
+        return self.font.get_glyphs(text)[0]
+
+class SDFFont(base.Font):
+    '''A font of a particular size and resolution drawn by scaling the
+    distance field glyphs of its face.
+    '''
+    glyph_renderer_class = SDFGlyphRenderer
+
+    # glyph_cache uses this to leave the on-disk caching to the face
+    distance_field = True
+
+    def __init__(self, name, size, bold=False, italic=False, dpi=None):
+        super(SDFFont, self).__init__()
+        if dpi is None:
+            dpi = 96
+        self.face = get_face(name, bold, italic)
+        self.scale = size * dpi / 72. / REFERENCE_SIZE
+        self.ascent = self.face.ascent * self.scale
+        self.descent = self.face.descent * self.scale
+        self.textures = self.face.textures
+
+    @classmethod
+    def have_font(cls, name):
+        return _base_class.have_font(name)
+
+    @classmethod
+    def add_font_data(cls, data):
+        _base_class.add_font_data(data)
+
+    def get_glyphs(self, text):
+        chars = set(base.get_grapheme_clusters(unicode(text)))
+        if u'\t' in chars:
+            chars.add(u' ')
+        chars = [c for c in chars if c != u'\t' and c not in self.glyphs]
+        if chars:
+            self.face.add_glyphs(chars)
+            for c in chars:
+                self.glyphs[c] = self._scale(self.face.glyphs[c])
+        return super(SDFFont, self).get_glyphs(text)
+
+    def _scale(self, glyph):
+        scaled = glyph.owner.get_region(glyph.x, glyph.y, glyph.width,
+            glyph.height)
+        scaled.vertices = tuple([v * self.scale for v in glyph.vertices])
+        scaled.advance = glyph.advance * self.scale
+        return scaled
+
+class SDFTextureGroup(layout.TextLayoutTextureGroup):
+    '''Text layout texture group which draws distance field textures using
+    the shader.
+    '''
+    def __init__(self, texture, parent):
+        # pyglet's __init__ uses super() with the name we're replacing it
+        # with, so bypass it
+        pyglet.graphics.Group.__init__(self, parent)
+        self.texture = texture
+        self.distance_field = isinstance(texture, SDFTextureAtlas)
+
+    def set_state(self):
+        glBindTexture(GL_TEXTURE_2D, self.texture.id)
+        if self.distance_field:
+            _program.install()
+
+    def unset_state(self):
+        if self.distance_field:
+            _program.uninstall()
+
+_base_class = None
+_program = None
+
+def install():
+    '''Switch all text rendering over to distance field glyphs.
+
+    Must be called once the OpenGL context exists but before any fonts are
+    loaded. Returns False (with a warning) if the OpenGL driver doesn't
+    support the shader.
+    '''
+    global _base_class, _program
+    from cocos import shader
+    try:
+        program = shader.ShaderProgram()
+        program.setShader(shader.FragmentShader('sdf_text', _fragment_shader))
+        program.prog()
+    except Exception, error:
+        warnings.warn('distance field text not available: %s'%error)
+        return False
+    _program = program
+    _base_class = pyglet.font._font_class
+    pyglet.font._font_class = SDFFont
+    layout.TextLayoutTextureGroup = SDFTextureGroup
+    return True
+
+__all__ = ['install', 'distance_field', 'SDFFont', 'SDFFace']
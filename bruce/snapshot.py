@@ -0,0 +1,75 @@
+'''Render-to-texture snapshots of pages used while running transitions.
+
+Transitions draw both the outgoing and incoming scenes every frame. Pages
+full of text layouts are expensive to draw, so instead each page is drawn
+once into a texture and the transition animates a pair of textured quads.
+'''
+import pyglet
+from pyglet.gl import *
+
+import cocos
+from cocos.director import director
+from cocos import framegrabber
+
+from bruce import redraw
+
+class PageSnapshot(cocos.scene.Scene):
+    '''Stand-in scene for a Page which displays a single texture holding
+    the rendered page.
+
+    When the transition finishes it will replace itself with the real
+    page.
+    '''
+    def __init__(self, page):
+        super(PageSnapshot, self).__init__()
+        self.page = page
+
+        w, h = director.window.get_size()
+        self.texture = pyglet.image.Texture.create_for_size(GL_TEXTURE_2D,
+            w, h, GL_RGBA)
+        self.width, self.height = w, h
+
+        # render the page once into our texture
+        grabber = framegrabber.TextureGrabber()
+        grabber.grab(self.texture)
+        bgcolor = page.stylesheet['layout']['background_color']
+        glClearColor(*[c/255. for c in bgcolor])
+        grabber.before_render(self.texture)
+        page.visit()
+        grabber.after_render(self.texture)
+
+    def on_enter(self):
+        super(PageSnapshot, self).on_enter()
+
+        # if we're being entered as a top-level scene then the transition
+        # has finished and the real page should take over
+        if self.parent is None:
+            director.replace(self.page)
+            redraw.invalidate()
+
+    def draw(self):
+        glPushAttrib(GL_ENABLE_BIT | GL_CURRENT_BIT)
+        glEnable(self.texture.target)
+        glBindTexture(self.texture.target, self.texture.id)
+        glColor4f(1, 1, 1, 1)
+        w, h = self.width, self.height
+        tw, th = self.texture.width, self.texture.height
+        u, v = w / float(tw), h / float(th)
+        glBegin(GL_QUADS)
+        glTexCoord2f(0, 0); glVertex2f(0, 0)
+        glTexCoord2f(u, 0); glVertex2f(w, 0)
+        glTexCoord2f(u, v); glVertex2f(w, h)
+        glTexCoord2f(0, v); glVertex2f(0, h)
+        glEnd()
+        glPopAttrib()
+
+def snapshot(page):
+    '''Create a snapshot of the page, or return None if render-to-texture
+    isn't available on this machine.
+    '''
+    try:
+        return PageSnapshot(page)
+    except Exception, error:
+        import warnings
+        warnings.warn('page snapshots not available: %s'%error)
+        return None
@@ -0,0 +1,57 @@
+from docutils import nodes
+from docutils.parsers.rst import directives
+
+import pyglet
+
+#
+# Sound directive
+#
+class sound(nodes.Special, nodes.Invisible, nodes.Element):
+    '''Document tree node representing a sound directive.
+    '''
+    def get_sound(self):
+        kw = {}
+        if self.has_key('volume'):
+            kw['volume'] = self['volume']
+        return Cue(self.rawsource, **kw)
+
+def sound_directive(name, arguments, options, content, lineno,
+                          content_offset, block_text, state, state_machine):
+    return [ sound('\n'.join(arguments), **options) ]
+sound_directive.arguments = (1, 0, 1)
+sound_directive.options = dict(
+     volume=float,
+)
+sound_directive.content = False
+def register_directives():
+    directives.register_directive('sound', sound_directive)
+
+# sound resource name -> StaticSource
+_sources = {}
+
+def load(name):
+    '''Decode the named sound resource into memory, if that's not already
+    been done.
+    '''
+    if name not in _sources:
+        _sources[name] = pyglet.resource.media(name, streaming=False)
+    return _sources[name]
+
+class Cue(object):
+    '''A short sound played when its page is entered or the list item it's
+    in is exposed.
+
+    The sound is decoded when the cue is parsed so playing it only needs
+    an audio player.
+    '''
+    def __init__(self, sound_filename, volume=1.0):
+        self.sound_filename = sound_filename.strip()
+        self.volume = volume
+        self.source = load(self.sound_filename)
+
+    def play(self):
+        player = pyglet.media.ManagedSoundPlayer()
+        player.volume = self.volume
+        player.queue(self.source)
+        player.play()
+
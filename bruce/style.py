@@ -204,8 +204,13 @@ class Stylesheet(dict):
             new[k] = self[k].copy()
         return new
 
-    def get_transition(self):
-        klass = _transitions[self['transition']['name']]
+    def get_transition(self, name=None):
+        '''Get the page transition function for the named transition,
+        defaulting to the one in this stylesheet.
+        '''
+        if name is None:
+            name = self['transition']['name']
+        klass = _transitions[name]
         if klass is None: return None
 
         kwargs = dict(duration=self['transition']['duration'])
@@ -213,7 +218,9 @@ class Stylesheet(dict):
         if klass is transitions.FadeTransition:
             kwargs['color'] = self['layout']['background_color'][:3]
 
-        def _transition(new_scene, klass=klass, kwargs=kwargs):
+        def _transition(new_scene, src=None, klass=klass, kwargs=kwargs):
+            if src is not None:
+                kwargs = dict(kwargs, src=src)
             director.replace(klass(new_scene, **kwargs))
 
         return _transition
@@ -0,0 +1,131 @@
+'''Rasterizing of SVG images.
+
+SVG images are drawn (using rsvg and cairo, if they're installed) at the
+size they'll be displayed, so they stay sharp at any scale. The natural
+size of an SVG is read from its root element's width and height (or
+viewBox), taking 96 pixels to the inch.
+
+bruce.image_loader handles SVGs like other images, so the rasterized
+pixels are kept in memory and in the on-disk cache keyed by the file's
+hash and the target size.
+'''
+import re
+import sys
+import array
+import gzip
+from cStringIO import StringIO
+from xml.etree import cElementTree
+
+try:
+    import rsvg
+    import cairo
+except ImportError:
+    rsvg = None
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+# pixels per unit, at 96 pixels to the inch
+UNITS = {'px': 1., 'pt': 96/72., 'pc': 16., 'mm': 96/25.4, 'cm': 96/2.54,
+    'in': 96., 'em': 16., 'ex': 8.}
+
+_length_re = re.compile(r'^\s*([0-9.eE+-]+)\s*([a-z]*)\s*$')
+
+def is_svg(name):
+    '''Determine whether the named image resource is an SVG.
+    '''
+    return name.lower().endswith(('.svg', '.svgz'))
+
+def _length(value):
+    # lengths in percent depend on the viewer, so aren't sizes
+    match = _length_re.match(value or '')
+    if match is None:
+        return None
+    number, unit = match.groups()
+    if unit and unit not in UNITS:
+        return None
+    return float(number) * UNITS.get(unit, 1.)
+
+def _unzip(data):
+    if data.startswith('\x1f\x8b'):
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+    return data
+
+def read_size(file):
+    '''Determine an SVG's natural (width, height) in pixels from its root
+    element. Returns None if it has no usable size.
+    '''
+    data = _unzip(file.read())
+    for event, element in cElementTree.iterparse(StringIO(data), ('start',)):
+        width = _length(element.get('width'))
+        height = _length(element.get('height'))
+        view_box = element.get('viewBox')
+        if view_box and (width is None or height is None):
+            try:
+                box_width, box_height = map(float,
+                    view_box.replace(',', ' ').split())[2:]
+            except ValueError:
+                return None
+            if width is None and height is None:
+                width, height = box_width, box_height
+            elif width is None:
+                width = height * box_width / box_height
+            else:
+                height = width * box_height / box_width
+        if not width or not height:
+            return None
+        return int(round(width)), int(round(height))
+    return None
+
+def _unpremultiply(pixels, alpha):
+    '''Divide the colour of each 4-byte pixel by its alpha (the byte at
+    offset `alpha`), as PIL's "BGRa" mode does, so the image blends like
+    the others.
+    '''
+    data = array.array('B', pixels)
+    colours = [i for i in range(4) if i != alpha]
+    for i in xrange(0, len(data), 4):
+        a = data[i + alpha]
+        if a == 0 or a == 255:
+            # only the anti-aliased edges need work
+            continue
+        for c in colours:
+            data[i + c] = min(255, (data[i + c] * 255 + a // 2) // a)
+    return data.tostring()
+
+def rasterize(data, size=None):
+    '''Draw the SVG document at `size` (its natural size if not given.)
+
+    Returns its natural size, then the pixel format and data of the image
+    with rows running top to bottom.
+    '''
+    if rsvg is None:
+        raise ImportError('SVG images need the rsvg and cairo modules')
+    handle = rsvg.Handle(data=_unzip(data))
+    natural = handle.props.width, handle.props.height
+    width, height = size or natural
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    context = cairo.Context(surface)
+    context.scale(width / float(natural[0]), height / float(natural[1]))
+    handle.render_cairo(context)
+    surface.flush()
+    pixels = str(surface.get_data())
+
+    # cairo's pixels are native-endian words with premultiplied alpha
+    if sys.byteorder == 'little':
+        if Image is not None:
+            image = Image.frombuffer('RGBA', (width, height), pixels, 'raw',
+                'BGRa', 0, 1)
+            if hasattr(image, 'tobytes'):
+                return natural, 'RGBA', image.tobytes()
+            return natural, 'RGBA', image.tostring()
+        return natural, 'BGRA', _unpremultiply(pixels, 3)
+    return natural, 'ARGB', _unpremultiply(pixels, 0)
+
+__all__ = ['is_svg', 'read_size', 'rasterize']
@@ -9,6 +9,7 @@ import pyglet
 from pyglet.gl import *
 
 from bruce import rst_parser
+from bruce import text_flow
 
 
 class TableElement(pyglet.text.document.InlineElement):
@@ -76,15 +77,23 @@ class BlendGroup(pyglet.graphics.Group):
     def unset_state(self):
         glPopAttrib()
 
+def _offset(vertices, x, y):
+    moved = list(vertices)
+    moved[0::2] = [vx + x for vx in vertices[0::2]]
+    moved[1::2] = [vy + y for vy in vertices[1::2]]
+    return moved
+
 class TableGenerator(object):
     def __init__(self, element):
         self.element = element
         self.num_rows = self.num_columns = 0
         self.cells = {}
         self.cell_layouts = {}
+        self.text_runs = []
+        self.text_background = ([], [])
         self.cell_colors = {}
         self.column_specs = []
-        self.cell_decoration = {}
+        self.background_decoration = None
         self.border_decoration = None
         self.body_rows = set()
         self.heading_rows = set()
@@ -121,14 +130,12 @@ class TableGenerator(object):
                 iter = document.get_style_runs('color')
                 self.cell_colors[row, col] = list(iter.ranges(iter.start, iter.end))
 
-                l = pyglet.text.layout.IncrementalTextLayout(
-                    document, width, 50, dpi=self.element.dpi,
-                    multiline=True)
-                rowheight = max(rowheight, l.content_height)
-                width = l.content_width + hpad
+                content_width, content_height = text_flow.measure(document,
+                    width, self.element.dpi)
+                rowheight = max(rowheight, content_height)
+                width = content_width + hpad
                 width += 1      # seems to be a rounding error
                 self.column_widths[col] = max(width, self.column_widths[col])
-                l.delete()
             if style['border']:
                 if row in self.heading_rows:
                     # heading row
@@ -146,12 +153,134 @@ class TableGenerator(object):
 
         # style info
         style = self.element.stylesheet['table']
-        vpad = style['top_padding'] + style['bottom_padding']
-        hpad = style['left_padding'] + style['right_padding']
 
         v = self.opacity/255.
 
-        # place in the real layout
+        self.delete_text()
+        if not self.glyph_layout(layout):
+            self.cell_layout(layout)
+
+        # cell backgrounds then text backgrounds, positioned by
+        # move_layout()
+        if self.background_decoration:
+            self.background_decoration.delete()
+        colors = self.background_colors(v)
+        n = len(colors) // 4
+        self.background_decoration = layout.batch.add(n,
+            pyglet.gl.GL_QUADS, layout.background_group,
+            ('v2f', [0] * 2 * n), ('c4B', colors))
+
+        # border lines
+        if style['border']:
+            color = style['border_color']
+            l = [0] * 4 * (self.num_rows-1 + self.num_columns-1)
+            n = len(l)//2
+            if self.border_decoration:
+                self.border_decoration.delete()
+            color = color[:3] + (int(color[3] * v),)
+            self.border_decoration = layout.batch.add(n,
+                pyglet.gl.GL_LINES, layout.foreground_decoration_group,
+                ('v2i', l), ('c4B', color * n),
+            )
+
+    def background_colors(self, v):
+        colors = []
+        for row in range(self.num_rows):
+            color = self.background_color(row)
+            color = color[:3] + (int(color[3] * v),)
+            colors.extend(color * 4 * self.num_columns)
+        text_colors = list(self.text_background[1])
+        text_colors[3::4] = [int(a * v) for a in text_colors[3::4]]
+        return colors + text_colors
+
+    def background_color(self, row):
+        style = self.element.stylesheet['table']
+        if row in self.heading_rows:
+            return style['heading_background_color']
+        elif row%2:
+            return style['odd_background_color']
+        return style['even_background_color']
+
+    def glyph_layout(self, layout):
+        '''Draw the text of all the cells from one vertex list per glyph
+        texture (usually just the one.) The vertices are kept relative to
+        the top-left of the table for move_layout() to offset.
+
+        Text background colours are drawn as quads over the cell
+        backgrounds, kept in text_background.
+
+        Returns False if some cell's text can't be drawn this way (it has
+        inline elements or underlining.)
+        '''
+        style = self.element.stylesheet['table']
+        hpad = style['left_padding'] + style['right_padding']
+        v = self.opacity/255.
+
+        # glyph texture -> (vertices, tex_coords, colors)
+        runs = {}
+        background_vertices = []
+        background_colors = []
+        top = 0
+        for row in range(self.num_rows):
+            left = 0
+            for col in range(self.num_columns):
+                document = self.cells[row, col]
+                iter = document.get_style_runs('underline')
+                for s, e, value in iter.ranges(0, len(document.text)):
+                    if value is not None:
+                        return False
+                placed = text_flow.place_glyphs(document,
+                    self.column_widths[col]-hpad, self.element.dpi)
+                if placed is None:
+                    if document.text:
+                        return False
+                    placed = []
+
+                colors = document.get_style_runs('color')
+                backgrounds = document.get_style_runs('background_color')
+                ox = left + style['left_padding']
+                oy = top - style['top_padding']
+                for index, x, y, glyph, font in placed:
+                    x += ox
+                    y += oy
+                    background = backgrounds[index]
+                    if background is not None:
+                        x2 = x + glyph.advance
+                        y1 = y + font.descent
+                        y2 = y + font.ascent
+                        background_vertices.extend([x, y1, x2, y1, x2, y2,
+                            x, y2])
+                        background_colors.extend(background * 4)
+                    v0, v1, v2, v3 = glyph.vertices
+                    if glyph.owner not in runs:
+                        runs[glyph.owner] = ([], [], [])
+                    vertices, tex_coords, glyph_colors = runs[glyph.owner]
+                    vertices.extend([x + v0, y + v1, x + v2, y + v1,
+                        x + v2, y + v3, x + v0, y + v3])
+                    tex_coords.extend(glyph.tex_coords)
+                    glyph_colors.extend((colors[index] or (0, 0, 0, 255)) * 4)
+                left += self.column_widths[col]
+            top -= self.row_heights[row]
+
+        for owner, (vertices, tex_coords, colors) in runs.items():
+            group = pyglet.text.layout.TextLayoutTextureGroup(owner,
+                layout.foreground_group)
+            n = len(vertices) // 2
+            faded = list(colors)
+            faded[3::4] = [int(a * v) for a in colors[3::4]]
+            vertex_list = layout.batch.add(n, pyglet.gl.GL_QUADS, group,
+                ('v2f', vertices), ('t3f', tex_coords), ('c4B', faded))
+            self.text_runs.append((vertex_list, vertices, colors))
+        self.text_background = (background_vertices, background_colors)
+        return True
+
+    def cell_layout(self, layout):
+        '''Draw the text of each cell with its own text layout.
+        '''
+        style = self.element.stylesheet['table']
+        vpad = style['top_padding'] + style['bottom_padding']
+        hpad = style['left_padding'] + style['right_padding']
+
         for row in range(self.num_rows):
             height = self.row_heights[row]-vpad
             if style['border']:
@@ -163,8 +292,6 @@ class TableGenerator(object):
                     height -= 1
             for col in range(self.num_columns):
                 document = self.cells[row, col]
-                if (row, col) in self.cell_layouts:
-                    self.cell_layouts[row, col].delete()
                 l = pyglet.text.layout.IncrementalTextLayout(
                     document, self.column_widths[col]-hpad, height,
                     dpi=self.element.dpi, multiline=True,
@@ -172,43 +299,6 @@ class TableGenerator(object):
 
                 self.cell_layouts[row, col] = l
 
-        # cell backgrounds
-        for row in range(self.num_rows):
-            height = self.row_heights[row]
-            x = 0
-            for col in range(self.num_columns):
-                colwidth = self.column_widths[col]
-                x2 = x + colwidth
-                if row in self.heading_rows:
-                    color = style['heading_background_color']
-                elif row%2:
-                    color = style['odd_background_color']
-                else:
-                    color = style['even_background_color']
-                color = color[:3] + (int(color[3] * v),)
-                r = layout.batch.add(4, pyglet.gl.GL_QUADS,
-                    layout.background_group,
-                    ('v2i', (x, 0, x2, 0, x2, height, x, height)),
-                    ('c4B', color * 4),
-                )
-                x = x2
-                if (row, col) in self.cell_decoration:
-                    self.cell_decoration[row, col].delete()
-                self.cell_decoration[row, col] = r
-
-        # border lines
-        if style['border']:
-            color = style['border_color']
-            l = [0] * 4 * (self.num_rows-1 + self.num_columns-1)
-            n = len(l)//2
-            if self.border_decoration:
-                self.border_decoration.delete()
-            color = color[:3] + (int(color[3] * v),)
-            self.border_decoration = layout.batch.add(n,
-                pyglet.gl.GL_LINES, layout.foreground_decoration_group,
-                ('v2i', l), ('c4B', color * n),
-            )
-
     _r = None
     def place(self, layout, x, y):
         '''Place myself in the layout where (x, y) define the lower-left corner
@@ -229,29 +319,38 @@ class TableGenerator(object):
 
         # we lay out from the top so start at the top - the first
         # row is just above the baseline (the supplied y)
-        ry = y + self.row_heights[0]
+        top = ry = y + self.row_heights[0]
+        backgrounds = []
         for row in range(self.num_rows):
             cx = x
             height = self.row_heights[row]
             for column in range(self.num_columns):
                 # update layout
-                l = self.cell_layouts[row, column]
-                l.begin_update()
-                l.anchor_y = 'top'
-                l.y = ry - style['top_padding']
-                l.x = cx + style['left_padding']
-                l.end_update()
+                if self.cell_layouts:
+                    l = self.cell_layouts[row, column]
+                    l.begin_update()
+                    l.anchor_y = 'top'
+                    l.y = ry - style['top_padding']
+                    l.x = cx + style['left_padding']
+                    l.end_update()
 
                 # update decoration
                 colwidth = self.column_widths[column]
                 x2 = cx + colwidth
-                r = self.cell_decoration[row, column]
-                r.vertices[:] = [cx, ry-height, x2, ry-height, x2, ry, cx, ry]
+                backgrounds.extend([cx, ry-height, x2, ry-height, x2, ry,
+                    cx, ry])
 
                 cx += self.column_widths[column]
 
             ry -= height
 
+        # glyph runs and text backgrounds are relative to the top-left of
+        # the table
+        self.background_decoration.vertices[:] = backgrounds + \
+            _offset(self.text_background[0], x, top)
+        for vertex_list, vertices, colors in self.text_runs:
+            vertex_list.vertices[:] = _offset(vertices, x, top)
+
         if style['border']:
             w = sum(self.column_widths)
             h = sum(self.row_heights)
@@ -268,24 +367,27 @@ class TableGenerator(object):
 
         self.x, self.y = x, y
 
-    def delete_layout(self, layout):
+    def delete_text(self):
         for v in self.cell_layouts.values():
             v.delete()
         self.cell_layouts = {}
-        for v in self.cell_decoration.values():
-            v.delete()
-        self.cell_decoration = {}
-        self.border_decoration.delete()
-        self.border_decoration = None
+        for vertex_list, vertices, colors in self.text_runs:
+            vertex_list.delete()
+        self.text_runs = []
+        self.text_background = ([], [])
+
+    def delete_layout(self, layout):
+        self.delete_text()
+        self.background_decoration.delete()
+        self.background_decoration = None
+        if self.border_decoration:
+            self.border_decoration.delete()
+            self.border_decoration = None
         self.parent_layout = self.x = self.y = None
 
-    def set_opacity(self, opacity):
-        self.opacity = opacity
-        v = opacity/255.
-        style = self.element.stylesheet['table']
+    def fade_cells(self, v):
         for row in range(self.num_rows):
             for column in range(self.num_columns):
-                # fade document
                 l = self.cell_layouts[row, column]
                 d = self.cells[row, column]
                 l.begin_update()
@@ -294,22 +396,31 @@ class TableGenerator(object):
                     d.set_style(s, e, dict(color=c))
                 l.end_update()
 
-                # fade background
-                if row in self.heading_rows:
-                    color = style['heading_background_color']
-                elif row%2:
-                    color = style['odd_background_color']
-                else:
-                    color = style['even_background_color']
-                l = self.cell_decoration[row, column]
-                color = color[:3] + (int(color[3] * v), )
-                l.colors[:] = color * 4
-
-                # fade border lines
-                color = style['border_color']
-                color = color[:3] + (int(color[3] * v), )
-                colors = color * (len(self.border_decoration.colors) // 4)
-                self.border_decoration.colors = colors
+    def set_opacity(self, opacity):
+        self.opacity = opacity
+        if self.parent_layout is None:
+            # full_layout() will use it
+            return
+        v = opacity/255.
+        style = self.element.stylesheet['table']
+
+        # fade text
+        if self.cell_layouts:
+            self.fade_cells(v)
+        for vertex_list, vertices, colors in self.text_runs:
+            faded = list(colors)
+            faded[3::4] = [int(a * v) for a in colors[3::4]]
+            vertex_list.colors[:] = faded
+
+        # fade backgrounds
+        self.background_decoration.colors[:] = self.background_colors(v)
+
+        # fade border lines
+        if self.border_decoration:
+            color = style['border_color']
+            color = color[:3] + (int(color[3] * v), )
+            colors = color * (len(self.border_decoration.colors) // 4)
+            self.border_decoration.colors[:] = colors
 
     def pop_style(self, *args):
         # NOP - we don't track styles
@@ -0,0 +1,564 @@
+'''Flowing page text into lines using a pool of worker processes.
+
+Breaking a page's text into lines is pure-Python work which pyglet does on
+the main thread as each page's text layout is created. With a worker pool
+started the glyph metrics and paragraph styles of each page are gathered
+up front and sent to the workers, which do the line breaking for all pages
+in parallel. The page's text layout then builds its lines from the results
+instead of flowing the text itself.
+
+The line breaking is the same as pyglet's (TextLayout._flow_glyphs_wrap)
+but works on plain glyph indexes and metrics so it needs no fonts or
+OpenGL in the workers.
+
+The same line breaking, run in this process, measures text without
+creating a layout (see measure().)
+'''
+import bisect
+import warnings
+
+import pyglet
+from pyglet.text import runlist
+from pyglet.text import layout
+
+_pool = None
+
+def start(processes=None):
+    '''Start the worker processes; by default one per CPU.
+    '''
+    global _pool
+    import multiprocessing
+    _pool = multiprocessing.Pool(processes)
+
+def stop():
+    '''Shut down the worker processes once all pages have been created.
+    '''
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+def _runs(iterator, length, parse=None):
+    runs = []
+    for start, end, value in iterator.ranges(0, length):
+        if parse is not None:
+            value = parse(value)
+        runs.append((start, end, value))
+    return runs
+
+def _make_job(document, width, dpi):
+    '''Gather the document's glyph metrics and paragraph styles for flow().
+
+    Returns the job with the glyph owners and fonts it refers to by index
+    and the glyph (or None for an inline element) of each character, or
+    None if the document can't be flowed outside pyglet.
+    '''
+    text = document.text
+    if not text:
+        return None
+
+    # gather the glyph metrics exactly as the layout will see them
+    advances = []
+    text_glyphs = []
+    elements = {}
+    owner_ids = []
+    owners = []
+    fonts = []
+    font_runs = []
+    runs = runlist.ZipRunIterator((document.get_font_runs(dpi=dpi),
+        document.get_element_runs()))
+    for start, end, (font, element) in runs.ranges(0, len(text)):
+        if font not in fonts:
+            fonts.append(font)
+        font_runs.append((start, end, fonts.index(font)))
+        if element:
+            elements[start] = (element.ascent, element.descent,
+                element.advance)
+            advances.append(element.advance)
+            text_glyphs.append(None)
+            owner_ids.append(None)
+            continue
+        glyphs = font.get_glyphs(text[start:end])
+        if len(glyphs) != end - start:
+            # combining characters; leave these to pyglet
+            return None
+        text_glyphs.extend(glyphs)
+        for glyph in glyphs:
+            advances.append(glyph.advance)
+            if glyph.owner not in owners:
+                owners.append(glyph.owner)
+            owner_ids.append(owners.index(glyph.owner))
+
+    # runs of glyphs sharing a texture, as TextLayout._get_owner_runs
+    owner_runs = []
+    for i, owner in enumerate(owner_ids):
+        if owner_runs and owner_runs[-1][2] == owner:
+            owner_runs[-1][1] = i + 1
+        else:
+            owner_runs.append([i, i + 1, owner])
+
+    def distance(value, dpi=dpi):
+        if value is None:
+            return None
+        return layout._parse_distance(value, dpi)
+    def distances(values):
+        return [distance(value) for value in values]
+    def filtered(name, default, test=lambda value: value is not None):
+        return runlist.FilteredRunIterator(document.get_style_runs(name),
+            test, default)
+    length = len(text)
+    job = dict(
+        text=text,
+        width=width,
+        advances=advances,
+        elements=elements,
+        owner_runs=[tuple(run) for run in owner_runs],
+        font_runs=font_runs,
+        font_metrics=[(font.ascent, font.descent) for font in fonts],
+        align=_runs(filtered('align', 'left',
+            lambda value: value in ('left', 'right', 'center')), length),
+        wrap=_runs(filtered('wrap', True,
+            lambda value: value in (True, False)), length),
+        margin_left=_runs(filtered('margin_left', 0), length, distance),
+        margin_right=_runs(filtered('margin_right', 0), length, distance),
+        indent=_runs(filtered('indent', 0), length, distance),
+        kerning=_runs(filtered('kerning', 0), length, distance),
+        tab_stops=_runs(filtered('tab_stops', []), length, distances),
+    )
+    return job, owners, fonts, text_glyphs
+
+def submit(document, width, dpi):
+    '''Start flowing the document's text for a multiline layout of the
+    given width and resolution.
+
+    Returns a Flow to pass to FlowedTextLayout, or None if there's no worker
+    pool or the document can't be flowed in the background.
+    '''
+    if _pool is None:
+        return None
+    gathered = _make_job(document, width, dpi)
+    if gathered is None:
+        return None
+    job, owners, fonts, text_glyphs = gathered
+    return Flow(document.text, width, dpi, owners, fonts,
+        _pool.apply_async(flow, (job,)))
+
+class Flow(object):
+    '''The pending result of flowing a document's text in a worker.
+    '''
+    def __init__(self, text, width, dpi, owners, fonts, result):
+        self.text = text
+        self.width = width
+        self.dpi = dpi
+        self.owners = owners
+        self.fonts = fonts
+        self.result = result
+
+    def get_lines(self, text_layout, glyphs):
+        '''Wait for the worker and build the layout's lines from its
+        results. Returns None if the results don't apply to the layout.
+        '''
+        if (text_layout.document.text != self.text or
+                text_layout._width != self.width or
+                text_layout._dpi != self.dpi):
+            return None
+        try:
+            flowed = self.result.get()
+        except Exception, error:
+            warnings.warn('text flow failed in worker: %s'%error)
+            return None
+
+        lines = []
+        for (start, length, width, ascent, descent, align, margin_left,
+                margin_right, paragraph_begin, paragraph_end,
+                boxes) in flowed:
+            line = layout._Line(start)
+            line.length = length
+            line.width = width
+            line.ascent = ascent
+            line.descent = descent
+            line.align = align
+            line.margin_left = margin_left
+            line.margin_right = margin_right
+            line.paragraph_begin = paragraph_begin
+            line.paragraph_end = paragraph_end
+            for box in boxes:
+                if isinstance(box, int):
+                    # inline element; the layout has already boxed it
+                    line.boxes.append(glyphs[box])
+                    continue
+                owner, font, items, advance = box
+                line.boxes.append(layout._GlyphBox(self.owners[owner],
+                    self.fonts[font], [(kern, glyphs[i]) for kern, i in items],
+                    advance))
+            lines.append(line)
+        return lines
+
+class FlowedTextLayout(pyglet.text.layout.IncrementalTextLayout):
+    '''An incremental text layout which takes its initial lines from a Flow
+    computed in a worker process. Later changes are flowed by pyglet as
+    usual.
+    '''
+    def __init__(self, document, width, height, multiline=False, dpi=None,
+            batch=None, group=None, flow=None):
+        self._flow = flow
+        super(FlowedTextLayout, self).__init__(document, width, height,
+            multiline=multiline, dpi=dpi, batch=batch, group=group)
+
+    def _flow_glyphs(self, glyphs, owner_runs, start, end):
+        flow, self._flow = self._flow, None
+        lines = None
+        if flow is not None and start == 0 and self._multiline:
+            lines = flow.get_lines(self, glyphs)
+        if lines is None:
+            lines = super(FlowedTextLayout, self)._flow_glyphs(glyphs,
+                owner_runs, start, end)
+        for line in lines:
+            yield line
+
+#
+# Worker side
+#
+
+class _Runs(object):
+    '''Look up the value of a list of (start, end, value) runs by index.
+    '''
+    def __init__(self, runs, default=None):
+        self.starts = [start for start, end, value in runs]
+        self.values = [value for start, end, value in runs]
+        self.default = default
+
+    def __getitem__(self, index):
+        i = bisect.bisect_right(self.starts, index) - 1
+        if i < 0:
+            return self.default
+        return self.values[i]
+
+class _GlyphBox(object):
+    def __init__(self, owner, font, glyphs, advance, metrics):
+        self.owner = owner
+        self.font = font
+        self.glyphs = glyphs
+        self.advance = advance
+        self.ascent, self.descent = metrics
+        self.length = len(glyphs)
+
+    def pack(self):
+        return (self.owner, self.font, self.glyphs, self.advance)
+
+class _ElementBox(object):
+    glyphs = None
+    length = 1
+
+    def __init__(self, index, metrics):
+        self.index = index
+        self.ascent, self.descent, self.advance = metrics
+
+    def pack(self):
+        return self.index
+
+class _Line(object):
+    length = 0
+    ascent = 0
+    descent = 0
+    width = 0
+    paragraph_begin = False
+    paragraph_end = False
+
+    def __init__(self, start, align, margin_left, margin_right):
+        self.start = start
+        self.align = align
+        self.margin_left = margin_left
+        self.margin_right = margin_right
+        self.boxes = []
+
+    def add_box(self, box):
+        self.boxes.append(box)
+        self.length += box.length
+        self.ascent = max(self.ascent, box.ascent)
+        self.descent = min(self.descent, box.descent)
+        self.width += box.advance
+
+    def pack(self):
+        return (self.start, self.length, self.width, self.ascent,
+            self.descent, self.align, self.margin_left, self.margin_right,
+            self.paragraph_begin, self.paragraph_end,
+            [box.pack() for box in self.boxes])
+
+def flow(job):
+    '''Word-wrap the job's text into lines; run in a worker process.
+
+    Returns a list of packed lines.
+    '''
+    text = job['text']
+    total_width = job['width']
+    advances = job['advances']
+    elements = job['elements']
+    metrics = job['font_metrics']
+    font_runs = _Runs(job['font_runs'])
+    align_runs = _Runs(job['align'], 'left')
+    wrap_runs = _Runs(job['wrap'], True)
+    margin_left_runs = _Runs(job['margin_left'], 0)
+    margin_right_runs = _Runs(job['margin_right'], 0)
+    indent_runs = _Runs(job['indent'], 0)
+    kerning_runs = _Runs(job['kerning'], 0)
+    tab_stops_runs = _Runs(job['tab_stops'], [])
+
+    def new_line(start):
+        return _Line(start, align_runs[start], margin_left_runs[start],
+            margin_right_runs[start])
+
+    lines = []
+    line = new_line(0)
+    line.paragraph_begin = True
+    line.margin_left += indent_runs[0]
+    wrap = wrap_runs[0]
+    width = total_width - line.margin_left - line.margin_right
+
+    x = 0
+    run_accum = []
+    run_accum_width = 0
+    eol_ws = 0
+    next_start = 0
+    font = None
+    for start, end, owner in job['owner_runs']:
+        font = font_runs[start]
+        owner_accum = []
+        owner_accum_width = 0
+        owner_accum_commit = []
+        owner_accum_commit_width = 0
+        nokern = True
+
+        for index in range(start, end):
+            c = text[index]
+            advance = advances[index]
+            if nokern:
+                kern = 0
+                nokern = False
+            else:
+                kern = kerning_runs[index]
+
+            if c in u' \u200b\t':
+                # whitespace: commit pending runs to this line
+                for run in run_accum:
+                    line.add_box(run)
+                run_accum = []
+                run_accum_width = 0
+
+                if c == u'\t':
+                    for tab_stop in tab_stops_runs[index]:
+                        if tab_stop > x + line.margin_left:
+                            break
+                    else:
+                        tab = 50.
+                        tab_stop = (((x + line.margin_left) // tab) + 1) * tab
+                    kern = int(tab_stop - x - line.margin_left - advance)
+
+                owner_accum.append((kern, index))
+                owner_accum_commit.extend(owner_accum)
+                owner_accum_commit_width += owner_accum_width + advance + kern
+                eol_ws += advance + kern
+                owner_accum = []
+                owner_accum_width = 0
+                x += advance + kern
+                next_start = index + 1
+                continue
+
+            is_paragraph = c in u'\n\u2029'
+            is_newline = c == u'\u2028' or is_paragraph
+            if (wrap and x + kern + advance >= width) or is_newline:
+                if is_newline:
+                    # forced newline; commit everything pending
+                    for run in run_accum:
+                        line.add_box(run)
+                    run_accum = []
+                    run_accum_width = 0
+                    owner_accum_commit.extend(owner_accum)
+                    owner_accum_commit_width += owner_accum_width
+                    owner_accum = []
+                    owner_accum_width = 0
+                    line.length += 1
+                    next_start = index + 1
+
+                if owner_accum_commit:
+                    line.add_box(_GlyphBox(owner, font, owner_accum_commit,
+                        owner_accum_commit_width, metrics[font]))
+                    owner_accum_commit = []
+                    owner_accum_commit_width = 0
+
+                if is_newline and not line.boxes:
+                    line.ascent, line.descent = metrics[font]
+
+                if line.boxes or is_newline:
+                    line.width -= eol_ws
+                    if is_paragraph:
+                        line.paragraph_end = True
+                    lines.append(line.pack())
+                    line = new_line(next_start)
+                    if is_paragraph:
+                        line.paragraph_begin = True
+
+                    # remove kern from first glyph of line
+                    if run_accum and run_accum[0].glyphs:
+                        k, g = run_accum[0].glyphs[0]
+                        run_accum[0].glyphs[0] = (0, g)
+                        run_accum_width -= k
+                    elif owner_accum:
+                        k, g = owner_accum[0]
+                        owner_accum[0] = (0, g)
+                        owner_accum_width -= k
+                    else:
+                        nokern = True
+
+                    x = run_accum_width + owner_accum_width
+                    width = total_width - line.margin_left - line.margin_right
+
+            if index in elements:
+                run_accum.append(_ElementBox(index, elements[index]))
+                run_accum_width += advance
+                x += advance
+            elif is_paragraph:
+                wrap = wrap_runs[next_start]
+                line.margin_left += indent_runs[next_start]
+                width = total_width - line.margin_left - line.margin_right
+            elif not is_newline:
+                owner_accum.append((kern, index))
+                owner_accum_width += advance + kern
+                x += advance + kern
+            eol_ws = 0
+
+        if owner_accum_commit:
+            line.add_box(_GlyphBox(owner, font, owner_accum_commit,
+                owner_accum_commit_width, metrics[font]))
+        if owner_accum:
+            run_accum.append(_GlyphBox(owner, font, owner_accum,
+                owner_accum_width, metrics[font]))
+            run_accum_width += owner_accum_width
+
+    for run in run_accum:
+        line.add_box(run)
+    if not line.boxes:
+        if font is None:
+            font = font_runs[0]
+        line.ascent, line.descent = metrics[font]
+    lines.append(line.pack())
+    return lines
+
+#
+# Measurement
+#
+
+def _style_key(document):
+    # everything about the document's styles which may change its size
+    length = len(document.text)
+    key = []
+    for name in sorted(document._style_runs):
+        key.append((name, list(document.get_style_runs(name).ranges(0,
+            length))))
+    for start, end, element in document.get_element_runs().ranges(0, length):
+        if element is not None:
+            key.append((start, element.ascent, element.descent,
+                element.advance))
+    return repr(key)
+
+def _position_lines(document, lines, width, dpi):
+    '''Position the lines as IncrementalTextLayout._flow_lines does for a
+    layout of the given width with its top at y = 0.
+
+    Returns each line's (x, baseline y) and the content width and height.
+    '''
+    def distance(value):
+        if value is None:
+            return None
+        return layout._parse_distance(value, dpi)
+    def style(name, index, default=None):
+        value = document.get_style(name, index)
+        if value is None:
+            return default
+        return value
+
+    positions = []
+    content_width = 0
+    y = 0
+    line_spacing = leading = None
+    for (start, length, line_width, ascent, descent, align, margin_left,
+            margin_right, paragraph_begin, paragraph_end, boxes) in lines:
+        if paragraph_begin:
+            y -= distance(style('margin_top', start, 0))
+            line_spacing = distance(style('line_spacing', start))
+            leading = distance(style('leading', start, 0))
+        else:
+            y -= leading
+        if line_spacing is None:
+            y -= ascent
+        else:
+            y -= line_spacing
+        if align == 'left' or line_width > width:
+            x = margin_left
+        elif align == 'center':
+            x = (width - margin_left - margin_right - line_width) // 2 + \
+                margin_left
+        else:
+            x = width - margin_right - line_width
+        positions.append((x, y))
+        content_width = max(content_width, line_width + margin_left)
+        if line_spacing is None:
+            y += descent
+        if paragraph_end:
+            y -= distance(style('margin_bottom', start, 0))
+    return positions, content_width, -y
+
+_measurements = {}
+
+def measure(document, width, dpi):
+    '''Determine the (content_width, content_height) a multiline text
+    layout of the document would have at the given width and resolution,
+    without creating the layout or any vertex lists.
+
+    Results are cached by the document's text and styles, the width and
+    the resolution.
+    '''
+    key = (document.text, width, dpi, _style_key(document))
+    if key not in _measurements:
+        gathered = _make_job(document, width, dpi)
+        if gathered is None:
+            # empty or awkward text; leave it to pyglet
+            l = layout.IncrementalTextLayout(document, width, 50, dpi=dpi,
+                multiline=True)
+            size = l.content_width, l.content_height
+            l.delete()
+        else:
+            positions, content_width, content_height = _position_lines(
+                document, flow(gathered[0]), width, dpi)
+            size = content_width, content_height
+        _measurements[key] = size
+    return _measurements[key]
+
+def place_glyphs(document, width, dpi):
+    '''Flow the document's text as a multiline text layout of the given
+    width and resolution would, for drawing the glyphs without one.
+
+    Returns a list of (character index, x, baseline y, glyph, font) with
+    y = 0 at the top of the text, or None if the document has inline elements or
+    can't be flowed outside pyglet.
+    '''
+    gathered = _make_job(document, width, dpi)
+    if gathered is None:
+        return None
+    job, owners, fonts, text_glyphs = gathered
+    if job['elements']:
+        return None
+    lines = flow(job)
+    positions = _position_lines(document, lines, width, dpi)[0]
+    placed = []
+    for (x, y), line in zip(positions, lines):
+        for owner, font, items, advance in line[-1]:
+            for kern, index in items:
+                x += kern
+                placed.append((index, x, y, text_glyphs[index],
+                    fonts[font]))
+                x += text_glyphs[index].advance
+    return placed
+
+__all__ = ['start', 'stop', 'submit', 'measure', 'place_glyphs',
+    'FlowedTextLayout']
@@ -0,0 +1,227 @@
+'''Display of images too large for a single texture.
+
+The image is cut into tiles at a number of levels of detail (each half the
+size of the one before) once, in the background. When displayed only the
+tiles of the level nearest the displayed size which are actually on screen
+are loaded and uploaded, so texture memory follows the size of the screen
+rather than the size of the image.
+
+With PIL installed the tiles are stored in the on-disk cache and loaded
+from there as needed. Without it there's only the full-size level, cut
+from the decoded image which is kept in memory.
+'''
+import math
+import zlib
+import threading
+from cStringIO import StringIO
+
+import pyglet
+from pyglet.gl import *
+
+from bruce import cache
+from bruce import image_loader
+
+TILE_SIZE = 512
+
+_max_texture_size = None
+def max_texture_size():
+    global _max_texture_size
+    if _max_texture_size is None:
+        size = GLint()
+        glGetIntegerv(GL_MAX_TEXTURE_SIZE, byref(size))
+        _max_texture_size = size.value
+    return _max_texture_size
+
+def needs_tiling(image_size):
+    '''Determine whether an image of the given (width, height) won't fit in
+    a texture.
+    '''
+    return max(image_size) > max_texture_size()
+
+def _tile_box(level_size, tx, ty):
+    '''The (x, y, width, height) of a tile in its level, y upwards.
+    '''
+    width, height = level_size
+    x, y = tx * TILE_SIZE, ty * TILE_SIZE
+    return x, y, min(TILE_SIZE, width - x), min(TILE_SIZE, height - y)
+
+class TileSource(object):
+    '''The tiles of an image, cut in the background.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.levels = None
+        self.image_data = None
+        self.tiles = None
+        self.error = None
+        self.cut = threading.Event()
+
+    def decode(self):
+        try:
+            file = pyglet.resource.file(self.name)
+            try:
+                data = file.read()
+            finally:
+                file.close()
+            if image_loader.Image is None:
+                self.image_data = pyglet.image.load(self.name,
+                    file=StringIO(data))
+                self.levels = [(self.image_data.width,
+                    self.image_data.height)]
+            else:
+                self._cut_tiles(data)
+        except Exception, error:
+            self.error = error
+        self.cut.set()
+
+    def _cut_tiles(self, data):
+        self.key = cache.data_hash(data)
+        self.levels = cache.load('tiles', (self.key, 'levels'))
+        if self.levels is not None:
+            return
+
+        # keep the tiles in memory if there's no disk cache
+        if cache.get_directory('tiles') is None:
+            self.tiles = {}
+
+        Image = image_loader.Image
+        image = Image.open(StringIO(data)).convert('RGBA')
+        levels = []
+        while True:
+            width, height = image.size
+            level = len(levels)
+            levels.append((width, height))
+            for ty in range(int(math.ceil(height / float(TILE_SIZE)))):
+                for tx in range(int(math.ceil(width / float(TILE_SIZE)))):
+                    x, y, w, h = _tile_box((width, height), tx, ty)
+                    # PIL's rows run top to bottom
+                    tile = image.crop((x, height - y - h, x + w, height - y))
+                    entry = (w, h, zlib.compress(image_loader._image_bytes(
+                        tile)))
+                    if self.tiles is None:
+                        cache.save('tiles', (self.key, level, tx, ty), entry)
+                    else:
+                        self.tiles[level, tx, ty] = entry
+            if width <= TILE_SIZE and height <= TILE_SIZE:
+                break
+            image = image.resize((max(1, width // 2), max(1, height // 2)),
+                Image.ANTIALIAS)
+        if self.tiles is None:
+            cache.save('tiles', (self.key, 'levels'), levels)
+        self.levels = levels
+
+    def wait(self):
+        self.cut.wait()
+        if self.error is not None:
+            raise self.error
+
+    def get_tile(self, level, tx, ty):
+        '''Get the image for a tile.
+        '''
+        self.wait()
+        if self.image_data is not None:
+            x, y, w, h = _tile_box(self.levels[level], tx, ty)
+            return self.image_data.get_region(x, y, w, h)
+        if self.tiles is not None:
+            entry = self.tiles[level, tx, ty]
+        else:
+            entry = cache.load('tiles', (self.key, level, tx, ty))
+        w, h, data = entry
+        return pyglet.image.ImageData(w, h, 'RGBA', zlib.decompress(data),
+            -w * 4)
+
+_sources = {}
+
+def load(name):
+    '''Start cutting the named image resource into tiles in the background.
+
+    Returns a TileSource.
+    '''
+    if name not in _sources:
+        _sources[name] = TileSource(name)
+        image_loader.queue(_sources[name])
+    return _sources[name]
+
+class TiledImage(object):
+    '''The visible tiles of an image placed in a text layout.
+    '''
+    def __init__(self, source, layout, x, y, width, height, opacity):
+        self.source = source
+        self.layout = layout
+        self.x, self.y = x, y
+        self.width, self.height = width, height
+        self.opacity = opacity
+        self.tiles = {}
+
+        # use the smallest level at least as large as we're displayed
+        source.wait()
+        self.level = 0
+        for level, (w, h) in enumerate(source.levels):
+            if w >= width and h >= height:
+                self.level = level
+        self.level_size = source.levels[self.level]
+
+        self.update()
+
+    def visible_tiles(self):
+        layout = self.layout
+        lw, lh = self.level_size
+        sx = self.width / float(lw)
+        sy = self.height / float(lh)
+
+        # intersect the layout's view with the image
+        x1 = max(layout.view_x, self.x) - self.x
+        x2 = min(layout.view_x + layout.width, self.x + self.width) - self.x
+        y1 = max(layout.view_y - layout.height, self.y) - self.y
+        y2 = min(layout.view_y, self.y + self.height) - self.y
+        if x1 >= x2 or y1 >= y2:
+            return set()
+
+        size_x, size_y = TILE_SIZE * sx, TILE_SIZE * sy
+        last_x = int(math.ceil(lw / float(TILE_SIZE))) - 1
+        last_y = int(math.ceil(lh / float(TILE_SIZE))) - 1
+        tiles = set()
+        for ty in range(int(y1 // size_y), min(last_y, int(y2 // size_y)) + 1):
+            for tx in range(int(x1 // size_x),
+                    min(last_x, int(x2 // size_x)) + 1):
+                tiles.add((tx, ty))
+        return tiles
+
+    def update(self):
+        '''Load the tiles which have become visible and drop those which
+        no longer are.
+        '''
+        visible = self.visible_tiles()
+        for tile in set(self.tiles) - visible:
+            texture, vertex_list = self.tiles.pop(tile)
+            vertex_list.delete()
+
+        lw, lh = self.level_size
+        sx = self.width / float(lw)
+        sy = self.height / float(lh)
+        for tx, ty in visible - set(self.tiles):
+            texture = self.source.get_tile(self.level, tx, ty).get_texture()
+            group = pyglet.sprite.SpriteGroup(texture, GL_SRC_ALPHA,
+                GL_ONE_MINUS_SRC_ALPHA, self.layout.top_group)
+            x, y, w, h = _tile_box(self.level_size, tx, ty)
+            x1 = self.x + x * sx
+            y1 = self.y + y * sy
+            x2 = self.x + (x + w) * sx
+            y2 = self.y + (y + h) * sy
+            vertex_list = self.layout.batch.add(4, GL_QUADS, group,
+                ('v2f', (x1, y1, x2, y1, x2, y2, x1, y2)),
+                ('c4B', [255, 255, 255, self.opacity] * 4),
+                ('t3f', texture.tex_coords))
+            self.tiles[tx, ty] = (texture, vertex_list)
+
+    def set_opacity(self, opacity):
+        self.opacity = opacity
+        for texture, vertex_list in self.tiles.values():
+            vertex_list.colors[:] = [255, 255, 255, opacity] * 4
+
+    def delete(self):
+        for texture, vertex_list in self.tiles.values():
+            vertex_list.delete()
+        self.tiles = {}
+
+__all__ = ['needs_tiling', 'load', 'TileSource', 'TiledImage']
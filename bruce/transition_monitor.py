@@ -0,0 +1,69 @@
+import warnings
+
+import pyglet
+
+class TransitionMonitor(object):
+    '''Measure the frame times of transitions as they run and swap out any
+    transition which can't keep up with the desired frame rate for a
+    cheaper one for the rest of the presentation.
+    '''
+    # the cheaper transition to fall back to
+    fallback = dict(fade='none')
+    default_fallback = 'fade'
+
+    # how quickly the cost estimate follows new measurements
+    weight = .5
+
+    def __init__(self, fps):
+        self.budget = 1. / fps
+        self.costs = {}
+        self.substitutes = {}
+        self.name = None
+
+    def choose(self, name):
+        '''Return the name of the transition to actually use in place of the
+        named transition.
+        '''
+        while name in self.substitutes:
+            name = self.substitutes[name]
+        return name
+
+    def start(self, name, duration):
+        '''Start measuring the named transition which runs for `duration`
+        seconds.
+        '''
+        if self.name is not None:
+            self.stop()
+        if name == 'none' or not duration:
+            return
+        self.name = name
+        self.frame_times = []
+        pyglet.clock.schedule(self.tick)
+
+    def tick(self, dt):
+        self.frame_times.append(dt)
+
+    def on_transition_finished(self, page, page_num):
+        if self.name is not None:
+            self.stop()
+
+    def stop(self):
+        pyglet.clock.unschedule(self.tick)
+        name, self.name = self.name, None
+
+        # the first frame includes the transition setup and the last the
+        # switch to the real page, so ignore them
+        frame_times = self.frame_times[1:-1]
+        if not frame_times:
+            return
+        cost = sum(frame_times) / len(frame_times)
+        if name in self.costs:
+            cost = self.weight * cost + (1 - self.weight) * self.costs[name]
+        self.costs[name] = cost
+
+        if cost > self.budget and name not in self.substitutes:
+            substitute = self.fallback.get(name, self.default_fallback)
+            self.substitutes[name] = substitute
+            warnings.warn('transition %s takes %.1fms per frame (budget '
+                '%.1fms); using %s instead'%(name, cost*1000,
+                self.budget*1000, substitute))
@@ -3,6 +3,9 @@ from docutils.parsers.rst import directives
 
 import pyglet
 
+from bruce import redraw
+from bruce import video_loader
+
 #
 # Video directive
 #
@@ -18,9 +21,27 @@ class video(nodes.Special, nodes.Invisible, nodes.Element):
             kw['height'] = int(self['height'])
         if self.has_key('loop'):
             kw['loop'] = True
+        if self.has_key('mute'):
+            kw['mute'] = True
+        if self.has_key('start'):
+            kw['start'] = self['start']
+        if self.has_key('end'):
+            kw['end'] = self['end']
 
         return VideoElement(self.rawsource, **kw)
 
+def seconds(argument):
+    '''Convert a time given as seconds, "minutes:seconds" or
+    "hours:minutes:seconds" into seconds.
+    '''
+    t = 0
+    try:
+        for part in directives.unchanged_required(argument).split(':'):
+            t = t * 60 + float(part)
+    except ValueError:
+        raise ValueError('%r is not a time'%argument)
+    return t
+
 def video_directive(name, arguments, options, content, lineno,
                           content_offset, block_text, state, state_machine):
     return [ video('\n'.join(arguments), **options) ]
@@ -29,30 +50,35 @@ video_directive.options = dict(
      width=directives.positive_int,
      height=directives.positive_int,
      loop=directives.flag,
+     mute=directives.flag,
+     start=seconds,
+     end=seconds,
 )
 video_directive.content = True
 def register_directives():
     directives.register_directive('video', video_directive)
 
 class VideoElement(pyglet.text.document.InlineElement):
-    def __init__(self, video_filename, width=None, height=None, loop=False):
+    def __init__(self, video_filename, width=None, height=None, loop=False,
+            mute=False, start=0, end=None):
         self.video_filename = video_filename
 
         self.width_spec = width
         self.height_spec = height
 
-        video = pyglet.resource.media(self.video_filename)
         self.loop = loop
-        assert video.video_format
-        video_format = video.video_format
+        self.mute = mute
+        self.start = start
+        self.end = end
+        self.info = video_loader.probe(self.video_filename)
 
         # determine dimensions
-        self.video_width = video_format.width
-        self.video_height = video_format.height
-        if video_format.sample_aspect > 1:
-            self.video_width *= video_format.sample_aspect
-        elif video_format.sample_aspect < 1:
-            self.video_height /= video_format.sample_aspect
+        self.video_width = self.info.width
+        self.video_height = self.info.height
+        if self.info.sample_aspect > 1:
+            self.video_width *= self.info.sample_aspect
+        elif self.info.sample_aspect < 1:
+            self.video_height /= self.info.sample_aspect
 
         # scale based on dimensions supplied
         if height is not None and width is None:
@@ -65,15 +91,10 @@ class VideoElement(pyglet.text.document.InlineElement):
         self.width = width or self.video_width
         self.height = height or self.video_height
 
-        self.vertex_lists = {}
         self.opacity = 255
 
         super(VideoElement, self).__init__(self.height, 0, self.width)
 
-    def set_opacity(self, layout, opacity):
-        self.opacity = int(opacity)
-        self.vertex_lists[layout].colors[:] = [255, 255, 255, self.opacity]*4
-
     def set_scale(self, scale):
         width, height = self.width_spec, self.height_spec
 
@@ -93,59 +114,71 @@ class VideoElement(pyglet.text.document.InlineElement):
         self.descent = 0
         self.advance = self.width
 
-        # assumes only one player (layout) active at a time
-        self.player_needed = None
+    def prefetch(self):
+        video_loader.preroll(self.video_filename, self.loop, self.mute,
+            self.start, self.end)
 
-    player = video = None
+    # assumes only one layout displays the video at a time
+    player = layout = vertex_list = None
     def set_active(self, active):
         if not active:
-            self.player.next()
-            self.player = None
-            self.video = None
-            self.vertex_list.delete()
-            self.vertex_list = None
+            if self.player is not None:
+                redraw.release(self)
+                video_loader.release_player(self.player)
+                self.player = None
+                if self.vertex_list is not None:
+                    self._show(self._get_poster())
             return
 
-        if self.player_needed is None:
+        if self.vertex_list is None:
+            # not on screen
             return
 
-        self.video = pyglet.resource.media(self.video_filename)
-
-        layout, x, y = self.player_needed
-
-        # create the player
-        self.player = pyglet.media.Player()
-        self.player.queue(self.video)
-        if self.loop:
-            self.player.eos_action = self.player.EOS_LOOP
-        else:
-            self.player.eos_action = self.player.EOS_PAUSE
+        self.player = video_loader.get_player(self.video_filename, self.loop,
+            self.mute, self.start, self.end)
         self.player.play()
+        redraw.hold(self)
+        self._show(self.player.texture)
 
-        texture = self.player.texture
+    def _get_poster(self):
+        return video_loader.get_poster(self.video_filename, self.start)
 
-        group = pyglet.sprite.SpriteGroup(texture,
+    def _get_group(self, texture):
+        return pyglet.sprite.SpriteGroup(texture,
             pyglet.gl.GL_SRC_ALPHA, pyglet.gl.GL_ONE_MINUS_SRC_ALPHA,
-            layout.top_group)
+            self.layout.top_group)
+
+    def _show(self, texture):
+        # switch the vertex list over to drawing the texture
+        self.layout.batch.migrate(self.vertex_list, pyglet.gl.GL_QUADS,
+            self._get_group(texture), self.layout.batch)
+        self.vertex_list.tex_coords[:] = texture.tex_coords
+
+    def set_opacity(self, layout, opacity):
+        self.opacity = int(opacity)
+        if self.vertex_list is not None:
+            self.vertex_list.colors[:] = [255, 255, 255, self.opacity]*4
+
+    def place(self, layout, x, y):
+        # draw the poster frame until the video is playing
+        self.layout = layout
+        if self.player is not None:
+            texture = self.player.texture
+        else:
+            texture = self._get_poster()
 
-        # set up rendering the player texture
         x1 = int(x)
         y1 = int(y + self.descent)
         x2 = int(x + self.width)
         y2 = int(y + self.height + self.descent)
-        vertex_list = layout.batch.add(4, pyglet.gl.GL_QUADS, group,
+        self.vertex_list = layout.batch.add(4, pyglet.gl.GL_QUADS,
+            self._get_group(texture),
             ('v2i', (x1, y1, x2, y1, x2, y2, x1, y2)),
             ('c4B', (255, 255, 255, self.opacity) * 4),
             ('t3f', texture.tex_coords))
-        self.vertex_list = vertex_list
-
-    def set_opacity(self, opacity):
-        self.opacity = int(opacity)
-        self.vertex_list.colors[:] = [255, 255, 255, self.opacity]*4
-
-    def place(self, layout, x, y):
-        self.player_needed = (layout, x, y)
 
     def remove(self, layout):
-        self.player_needed = None
+        self.vertex_list.delete()
+        self.vertex_list = None
+        self.layout = None
 
@@ -0,0 +1,232 @@
+'''Preparation of video ahead of it being displayed.
+
+Each video is probed once for its size, duration and first frame (the
+poster, drawn until the video starts playing); the results are kept in the
+on-disk cache keyed by the file's path, size and modification time.
+
+Playing a clip from part way through a video seeks to the keyframe before
+it. Where the keyframes are is found once per video (again cached on disk)
+by seeking at KEYFRAME_STEP intervals and noting where the decoder lands.
+That takes a while for long videos so it's done a seek per frame on the
+main thread; until it's finished clips seek straight to their start time.
+
+Players (see bruce.video_player) are pre-rolled - decoding started and the
+first frame shown - before they're needed, typically while the page before
+the video's is showing, and are reused once their page is left.
+'''
+import os
+import zlib
+
+import pyglet
+
+from bruce import cache
+from bruce import video_player
+
+# most players kept idle for reuse, and most kept pre-rolled
+POOL_SIZE = 2
+
+# seconds between the seeks made looking for keyframes
+KEYFRAME_STEP = 1.
+
+def _file_key(name):
+    # hashing a video would take far too long; its path, size and
+    # modification time will do
+    location = pyglet.resource.location(name)
+    if not isinstance(location, pyglet.resource.FileLocation):
+        return None
+    path = os.path.abspath(os.path.join(location.path, name))
+    stat = os.stat(path)
+    return (path, stat.st_size, int(stat.st_mtime))
+
+class VideoInfo(object):
+    '''What's known about a video without playing it.
+    '''
+    def __init__(self, width, height, sample_aspect, duration, has_audio,
+            poster):
+        self.width = width
+        self.height = height
+        self.sample_aspect = sample_aspect
+        self.duration = duration
+        self.has_audio = has_audio
+        self.poster = poster
+        self.poster_texture = None
+
+    def get_poster(self):
+        '''Get the texture holding the video's first frame. Must be called
+        from the main thread.
+        '''
+        if self.poster_texture is None:
+            if self.poster is None:
+                data = '\0' * (self.width * self.height * 3)
+            else:
+                data = zlib.decompress(self.poster)
+            # the decoder's rows run top to bottom
+            image = pyglet.image.ImageData(self.width, self.height, 'RGB',
+                data, -self.width * 3)
+            self.poster_texture = image.get_texture()
+        return self.poster_texture
+
+def _probe_source(source, name):
+    video_format = source.video_format
+    if video_format is None:
+        raise ValueError('%r has no video'%name)
+    frame = source.get_next_video_frame()
+    poster = None
+    if frame is not None:
+        poster = zlib.compress(frame.get_data('RGB', video_format.width * 3))
+    return dict(width=video_format.width, height=video_format.height,
+        sample_aspect=video_format.sample_aspect, duration=source.duration,
+        has_audio=source.audio_format is not None, poster=poster)
+
+_info = {}
+
+def probe(name):
+    '''Get the VideoInfo for the named video resource.
+    '''
+    if name not in _info:
+        key = _file_key(name)
+        entry = None
+        if key is not None:
+            entry = cache.load('video', ('probe', key))
+        if entry is None:
+            entry = _probe_source(pyglet.resource.media(name), name)
+            if key is not None:
+                cache.save('video', ('probe', key), entry)
+        _info[name] = VideoInfo(**entry)
+    return _info[name]
+
+_keyframes = {}
+
+class _KeyframeIndex(object):
+    '''Finds a video's keyframes a seek at a time, once per frame on the
+    main thread (AVbin mustn't open or close sources from other threads
+    while it's doing so here.)
+    '''
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        self.source = pyglet.resource.media(name)
+        self.keyframes = set()
+        self.t = 0.
+        pyglet.clock.schedule(self.step)
+
+    def step(self, dt):
+        source = self.source
+        try:
+            timestamp = None
+            if source.duration is None or self.t < source.duration:
+                source._seek(self.t)
+                timestamp = source.get_next_video_timestamp()
+        except Exception:
+            # seeking straight to clips' start times will do
+            pyglet.clock.unschedule(self.step)
+            self.source = None
+            return
+        if timestamp is not None:
+            self.keyframes.add(timestamp)
+            self.t += KEYFRAME_STEP
+            return
+
+        pyglet.clock.unschedule(self.step)
+        self.source = None
+        keyframes = sorted(self.keyframes)
+        if self.key is not None:
+            cache.save('video', ('keyframes', self.key, KEYFRAME_STEP),
+                keyframes)
+        _keyframes[self.name] = keyframes
+
+def get_keyframes(name):
+    '''Get the sorted timestamps of the named video resource's keyframes.
+
+    If they've not been found yet this starts finding them, a little each
+    frame, and returns an empty list.
+    '''
+    if name not in _keyframes:
+        key = _file_key(name)
+        keyframes = None
+        if key is not None:
+            keyframes = cache.load('video', ('keyframes', key, KEYFRAME_STEP))
+        if keyframes is not None:
+            _keyframes[name] = keyframes
+            return keyframes
+        # until the index is done we'll seek without it
+        _keyframes[name] = []
+        try:
+            _KeyframeIndex(name, key)
+        except Exception:
+            pass
+    return _keyframes[name]
+
+_posters = {}
+
+def get_poster(name, start=0):
+    '''Get a texture holding the frame of the named video resource at
+    `start` seconds. Must be called from the main thread.
+    '''
+    info = probe(name)
+    if not start:
+        return info.get_poster()
+    if (name, start) not in _posters:
+        key = _file_key(name)
+        poster = None
+        if key is not None:
+            poster = cache.load('video', ('poster', key, start))
+        if poster is None:
+            source = pyglet.resource.media(name)
+            video_player.seek_source(source, start, get_keyframes(name))
+            frame = source.get_next_video_frame()
+            if frame is not None:
+                poster = zlib.compress(frame.get_data('RGB', info.width * 3))
+            if key is not None:
+                cache.save('video', ('poster', key, start), poster)
+        clip = VideoInfo(info.width, info.height, info.sample_aspect,
+            info.duration, info.has_audio, poster)
+        _posters[name, start] = clip.get_poster()
+    return _posters[name, start]
+
+_idle = []
+_prerolled = []
+
+def preroll(name, loop=False, mute=False, start=0, end=None):
+    '''Get a player ready to play the named video resource (from `start`
+    to `end` seconds.)
+    '''
+    key = (name, loop, mute, start, end)
+    for prerolled, player in _prerolled:
+        if prerolled == key:
+            return
+    if _idle:
+        player = _idle.pop()
+    else:
+        player = video_player.VideoPlayer()
+
+    # starts decoding, showing the first frame
+    keyframes = ()
+    if start:
+        keyframes = get_keyframes(name)
+    player.open(name, loop, mute, start, end, keyframes)
+
+    _prerolled.append((key, player))
+    if len(_prerolled) > POOL_SIZE:
+        key, player = _prerolled.pop(0)
+        release_player(player)
+
+def get_player(name, loop=False, mute=False, start=0, end=None):
+    '''Take the pre-rolled player for the named video resource, pre-rolling
+    one now if need be.
+    '''
+    preroll(name, loop, mute, start, end)
+    key = (name, loop, mute, start, end)
+    for i, (prerolled, player) in enumerate(_prerolled):
+        if prerolled == key:
+            del _prerolled[i]
+            return player
+
+def release_player(player):
+    '''Stop the player and keep it for reuse.
+    '''
+    player.stop()
+    if len(_idle) < POOL_SIZE:
+        _idle.append(player)
+
+__all__ = ['probe', 'get_keyframes', 'get_poster', 'preroll', 'get_player', 'release_player', 'VideoInfo']
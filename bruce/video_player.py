@@ -0,0 +1,344 @@
+'''Video playback with the decoding done in a background thread.
+
+A thread decodes frames into a bounded queue, getting a few frames ahead
+of playback. Each frame the main thread only uploads the newest frame
+that's due, counting any it had to skip over as dropped.
+
+The sound is played by a pyglet Player from a second copy of the source
+(so the two decoders never share a file) and its playback time is the
+clock the frames are shown against. Muted videos and those without sound
+don't decode audio at all and are shown against the wall clock.
+
+Short looping videos are only decoded once: their frames (and sound) are
+kept in memory and later passes are played from there.
+'''
+import time
+import bisect
+import threading
+import Queue
+
+import pyglet
+from pyglet.gl import *
+
+# decoded frames a player may get ahead of playback
+QUEUE_SIZE = 8
+
+# looping videos whose frames take no more than this are kept in memory
+RING_MAX_BYTES = 64 * 1024 * 1024
+
+stats = dict(decoded=0, shown=0, dropped=0)
+
+# put in the frame queue after the last frame
+_END = 'end'
+
+def _drop_stream(source, stream):
+    '''Stop an AVbin source decoding its 'audio' or 'video' stream.
+    '''
+    if stream == 'audio' and source.audio_format is not None:
+        source._buffer_streams.remove(source._audio_stream_index)
+        source.audio_format = None
+    elif stream == 'video' and source.video_format is not None:
+        source._buffer_streams.remove(source._video_stream_index)
+        source._video_stream_index = -1
+        source.video_format = None
+
+def _create_texture(width, height):
+    texture = pyglet.image.Texture.create_for_size(GL_TEXTURE_2D, width,
+        height, internalformat=GL_RGB)
+    if texture.width != width or texture.height != height:
+        texture = texture.get_region(0, 0, width, height)
+
+    # the decoder's rows run top to bottom
+    t = list(texture.tex_coords)
+    texture.tex_coords = t[9:12] + t[6:9] + t[3:6] + t[:3]
+    return texture
+
+class FrameRing(object):
+    '''All the frames of a short video, kept in memory for looping.
+    '''
+    def __init__(self, timestamps, images, duration):
+        self.timestamps = timestamps
+        self.images = images
+        self.duration = duration
+        self.audio = None
+
+    def get_frame(self, t):
+        '''Get the index of the frame shown at time `t`, which may be past
+        the end of the video.
+        '''
+        t %= self.duration
+        return max(0, bisect.bisect_right(self.timestamps, t) - 1)
+
+# (video name, start, end) -> FrameRing
+_rings = {}
+
+def seek_source(source, start, keyframes):
+    '''Seek a video source to its first frame at or after `start` by
+    seeking to the keyframe before it and decoding up to it.
+
+    Without `keyframes` the seek is straight to `start`, leaving the
+    decoder to find the keyframe before it.
+    '''
+    i = bisect.bisect_right(keyframes, start) - 1
+    if not keyframes:
+        source._seek(start)
+    elif i >= 0:
+        source._seek(keyframes[i])
+    else:
+        source._seek(0)
+    while True:
+        timestamp = source.get_next_video_timestamp()
+        if timestamp is None or timestamp >= start - .001:
+            return
+        source.get_next_video_frame()
+
+class VideoPlayer(object):
+    '''Plays one video at a time into its texture.
+
+    `decoded`, `shown` and `dropped` count the frames of the current video.
+    '''
+    texture = None
+    audio = None
+
+    def open(self, name, loop=False, mute=False, start=0, end=None,
+            keyframes=()):
+        '''Start decoding the named video resource, showing its first frame
+        in the texture.
+
+        Only the clip from `start` to `end` seconds is played; `keyframes`
+        are the timestamps it's quickest to seek to.
+        '''
+        self.name = name
+        self.loop = loop
+        self.start = start
+        self.end = end
+        self.keyframes = keyframes
+        self.decoded = self.shown = self.dropped = 0
+        self.frames = self.next_frame = self.thread = None
+        self.finished = False
+        self.stopping = False
+
+        # short looping videos we've seen before play from memory
+        self.ring = None
+        self.ring_frame = 0
+        if loop and (name, start, end) in _rings:
+            self.ring = _rings[name, start, end]
+            self.duration = self.ring.duration
+            image = self.ring.images[0]
+            self._open_texture(image.width, image.height)
+            self._open_audio(name, mute)
+            self._show(image)
+            return
+
+        self.source = pyglet.resource.media(name)
+        _drop_stream(self.source, 'audio')
+        self.duration = self.source.duration
+        if end is not None:
+            self.duration = end
+        if self.duration is not None:
+            self.duration -= start
+        video_format = self.source.video_format
+        self._open_texture(video_format.width, video_format.height)
+        self._open_audio(name, mute)
+
+        self.frames = Queue.Queue(QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._decode,
+            name='video-decoder')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        # show the first frame straight away
+        frame = self.frames.get()
+        if frame is _END:
+            self.next_frame = frame
+        else:
+            self._show(frame[1])
+
+    def _open_texture(self, width, height):
+        if self.texture is None or \
+                (self.texture.width, self.texture.height) != (width, height):
+            self.texture = _create_texture(width, height)
+
+    def _open_audio(self, name, mute):
+        self.audio_source = None
+        if mute:
+            return
+        if self.ring is not None and self.ring.audio is not None:
+            audio_source = self.ring.audio
+        else:
+            audio_source = pyglet.resource.media(name)
+            if audio_source.audio_format is None:
+                return
+            _drop_stream(audio_source, 'video')
+        self.audio_source = audio_source
+        if self.audio is None:
+            self.audio = pyglet.media.Player()
+        self.audio.queue(audio_source)
+        if self.loop and self.end is None:
+            self.audio.eos_action = self.audio.EOS_LOOP
+        else:
+            # clips ending early are stopped (or looped) in update()
+            self.audio.eos_action = self.audio.EOS_PAUSE
+        if self.start:
+            self.audio.seek(self.start)
+
+    def _decode(self):
+        # keep the frames of short looping videos so later passes needn't
+        # decode them again
+        recording = self.loop and self.duration
+        timestamps, images = [], []
+        size = 0
+
+        # timestamps are from the start of the clip and carry on increasing
+        # as we loop
+        offset = -self.start
+        looped = False
+        if self.start:
+            seek_source(self.source, self.start, self.keyframes)
+        while not self.stopping:
+            timestamp = self.source.get_next_video_timestamp()
+            if timestamp is None or (self.end is not None and
+                    timestamp >= self.end):
+                if recording and images:
+                    self._record(timestamps, images)
+                    self._put(_END)
+                    return
+                if self.loop and self.duration and not looped:
+                    seek_source(self.source, self.start, self.keyframes)
+                    offset += self.duration
+                    looped = True
+                    continue
+                self._put(_END)
+                return
+            looped = False
+            image = self.source.get_next_video_frame()
+            self.decoded += 1
+            stats['decoded'] += 1
+            if recording:
+                size += image.width * image.height * 3
+                if size > RING_MAX_BYTES:
+                    recording = False
+                    timestamps, images = [], []
+                else:
+                    timestamps.append(timestamp - self.start)
+                    images.append(image)
+            self._put((timestamp + offset, image))
+
+    def _record(self, timestamps, images):
+        ring = FrameRing(timestamps, images, self.duration)
+        if not self.start and self.end is None:
+            # clips play part of the streamed sound
+            audio_source = pyglet.resource.media(self.name)
+            if audio_source.audio_format is not None:
+                _drop_stream(audio_source, 'video')
+                ring.audio = pyglet.media.StaticSource(audio_source)
+        _rings[self.name, self.start, self.end] = ring
+        self.ring = ring
+
+    def _put(self, frame):
+        # wait for room, but not so long that we miss being stopped
+        while not self.stopping:
+            try:
+                self.frames.put(frame, timeout=.1)
+                return
+            except Queue.Full:
+                pass
+
+    def play(self):
+        self.start_time = time.time()
+        self.audio_time = 0
+        self.audio_loops = 0
+        if self.audio_source is not None:
+            self.audio.play()
+        pyglet.clock.schedule(self.update)
+
+    def get_time(self):
+        '''The playback position in seconds, increasing across loops.
+        '''
+        if self.audio_source is None:
+            return time.time() - self.start_time
+        t = (self.audio.time or self.start) - self.start
+        if not self.duration:
+            # some streams don't know their length; we can't tell if the
+            # sound has looped
+            return t
+        if t < self.audio_time - self.duration / 2:
+            # the sound has looped
+            self.audio_loops += 1
+        self.audio_time = t
+        return t + self.audio_loops * self.duration
+
+    def update(self, dt):
+        '''Upload the newest frame that's due.
+        '''
+        if self.audio_source is not None and self.end is not None and \
+                (self.audio.time or 0) >= self.end:
+            if self.loop:
+                self.audio.seek(self.start)
+            else:
+                self.audio.pause()
+
+        now = self.get_time()
+        if self.frames is None:
+            self._update_ring(now)
+            return
+
+        newest = None
+        while True:
+            if self.next_frame is None:
+                try:
+                    self.next_frame = self.frames.get_nowait()
+                except Queue.Empty:
+                    break
+            if self.next_frame is _END:
+                if self.ring is not None:
+                    # the video's now in memory; play it from there
+                    self.frames = self.next_frame = None
+                    self.ring_frame = len(self.ring.images) - 1
+                    self._update_ring(now)
+                    return
+                self.finished = True
+                break
+            timestamp, image = self.next_frame
+            if timestamp > now:
+                break
+            if newest is not None:
+                self.dropped += 1
+                stats['dropped'] += 1
+            newest = image
+            self.next_frame = None
+        if newest is not None:
+            self._show(newest)
+
+    def _update_ring(self, now):
+        frame = self.ring.get_frame(now)
+        if frame != self.ring_frame:
+            self.ring_frame = frame
+            self._show(self.ring.images[frame])
+
+    def _show(self, image):
+        self.texture.blit_into(image, 0, 0, 0)
+        self.shown += 1
+        stats['shown'] += 1
+
+    def stop(self):
+        '''Stop playback and decoding.
+        '''
+        pyglet.clock.unschedule(self.update)
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join()
+        if self.audio is not None:
+            self.audio.pause()
+            while self.audio.source is not None:
+                self.audio.next()
+        self.source = self.audio_source = self.ring = None
+        self.frames = self.next_frame = self.thread = None
+
+def report():
+    '''Display the video frame counters.
+    '''
+    print 'Video frames: %d decoded, %d shown, %d dropped'%(stats['decoded'],
+        stats['shown'], stats['dropped'])
+
+__all__ = ['VideoPlayer', 'FrameRing', 'seek_source', 'stats', 'report']
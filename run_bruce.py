@@ -9,4 +9,7 @@ sys.path.insert(0, '.')
 sys.path.insert(0, 'docutils-extras')
 
 import bruce.run
-bruce.run.main()
+
+# --layout-workers' processes re-import this script on Windows
+if __name__ == '__main__':
+    bruce.run.main()